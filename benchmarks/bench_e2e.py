@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#
+# End-to-end benchmark on simulated slaves (benchmarks/simulator.py, Linux).
+#
+# 1. Transactions: readline() of the register map drivers with the
+#    minimalmodbus and asyncio transports (samples/s, latency, CPU).
+# 2. Pipeline: logger.py -> broker.py -> subscriber, run as separate
+#    processes like on the Raspberry Pi (samples/s, acquisition to
+#    delivery latency, CPU of logger and broker).
+#
+# usage: python benchmarks/bench_e2e.py [--devices falco:100 falco:101]
+#            [--period 0.05] [--duration 10] [--polls 500] [--latency 0.002]
+#            [--transport minimalmodbus]
+
+import os, sys
+import time
+import glob
+import json
+import shutil
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+import numpy as np
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+repo_path = os.path.dirname(bench_path)
+sys.path.append(repo_path)
+sys.path.append(os.path.join(repo_path, 'drivers'))
+from broker import subscribe
+from registers import RegisterMap, RegisterMapInstrument
+from aio import AsyncRTUTransport, AsyncRegisterMapDevice
+
+def start_simulator(devices, latency):
+    """Start simulator.py in its own process and return (process, pty name)"""
+    process = subprocess.Popen([sys.executable, os.path.join(bench_path, 'simulator.py')]
+                               + devices + ['--latency', str(latency)],
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    return process, process.stdout.readline().strip()
+
+def pty_map(name):
+    """Return the register map name without parity (not supported by ptys)"""
+    register_map = RegisterMap.load(name)
+    register_map.serial = dict(register_map.serial, parity='N')
+    return register_map
+
+def stop(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def cpu_time(pid):
+    """Return the user + system CPU seconds used by the process pid"""
+    with open('/proc/{}/stat'.format(pid)) as fo:
+        fields = fo.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12]))/os.sysconf('SC_CLK_TCK')
+
+def report(label, latencies, elapsed, cpu):
+    latencies = np.asarray(latencies)*1e3
+    print("{:<28s} {:>8.1f} samples/s  latency ms: mean {:.2f} p50 {:.2f} p95 {:.2f} "
+          "max {:.2f}  CPU {:.0f}%".format(
+          label, len(latencies)/elapsed, latencies.mean(), np.percentile(latencies, 50),
+          np.percentile(latencies, 95), latencies.max(), 100*cpu/elapsed))
+
+def bench_transactions(port, devices, polls):
+    instruments = [RegisterMapInstrument(port, int(address), pty_map(name))
+                   for name, address in (d.split(':') for d in devices)]
+    latencies = []
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for i in range(polls):
+        t = time.perf_counter()
+        instruments[i % len(instruments)].readline()
+        latencies.append(time.perf_counter() - t)
+    report("minimalmodbus readline()", latencies, time.perf_counter() - start,
+           time.process_time() - cpu)
+
+    async def run():
+        transport = AsyncRTUTransport(port)
+        instruments = [AsyncRegisterMapDevice(transport, int(address), pty_map(name))
+                       for name, address in (d.split(':') for d in devices)]
+        latencies = []
+        cpu = time.process_time()
+        start = time.perf_counter()
+        for i in range(polls):
+            t = time.perf_counter()
+            await instruments[i % len(instruments)].readline()
+            latencies.append(time.perf_counter() - t)
+        report("asyncio readline()", latencies, time.perf_counter() - start,
+               time.process_time() - cpu)
+        transport.close()
+    asyncio.run(run())
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError("broker did not start")
+
+def bench_pipeline(port, devices, period, duration, transport):
+    # run copies of the scripts with their own config.ini and data directory
+    work = tempfile.mkdtemp(prefix='rs485bench-')
+    for filename in glob.glob(os.path.join(repo_path, '*.py')):
+        shutil.copy(filename, work)
+    shutil.copytree(os.path.join(repo_path, 'drivers'), os.path.join(work, 'drivers'),
+                    ignore=shutil.ignore_patterns('__pycache__'))
+    for filename in glob.glob(os.path.join(work, 'drivers', 'maps', '*.json')):
+        with open(filename) as fo:
+            data = json.load(fo)
+        data.setdefault('serial', {})['parity'] = 'N'
+        with open(filename, 'w') as fo:
+            json.dump(data, fo)
+    publish_port, subscribe_port = free_port(), free_port()
+    entries = [{'driver': name, 'address': int(address), 'period': period}
+               for name, address in (d.split(':') for d in devices)]
+    with open(os.path.join(work, 'config.ini'), 'w') as fo:
+        fo.write("[GENERAL_SETTINGS]\nPORT: '{}'\nADDRESS: 0\nDEVICES: {}\nDATA_PATH: '{}'\n\n"
+                 "[TCP_INTERFACE]\nHOST_NAME: '127.0.0.1'\nHOST_PORT: {}\nSUBSCRIBE_PORT: {}\n"
+                 "SEND_QUEUE: 10000\n\n"
+                 "[LOGGER]\nBUFFER: 120\nWAIT: {}\nTRANSPORT: '{}'\nFSYNC: 60\n"
+                 "DATAFILE: 'bench'\nEXTENSION: '.txt'\n".format(
+                 port, entries, os.path.join(work, 'data'), publish_port, subscribe_port,
+                 period, transport))
+
+    logfile = open(os.path.join(work, 'logger.log'), 'w')
+    broker = subprocess.Popen([sys.executable, os.path.join(work, 'broker.py')],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(subscribe_port)
+
+    received = []
+    def receive():
+        for timestamp, data in subscribe(('127.0.0.1', subscribe_port)):
+            received.append(time.time() - timestamp)
+    threading.Thread(target=receive, daemon=True).start()
+    time.sleep(0.5)
+
+    logger = subprocess.Popen([sys.executable, os.path.join(work, 'logger.py')],
+                              stdout=logfile, stderr=subprocess.STDOUT)
+    time.sleep(2)   # startup (imports, static registers)
+    count = len(received)
+    start = time.perf_counter()
+    cpu = {'logger': cpu_time(logger.pid), 'broker': cpu_time(broker.pid)}
+    time.sleep(duration)
+    elapsed = time.perf_counter() - start
+    cpu = {'logger': cpu_time(logger.pid) - cpu['logger'],
+           'broker': cpu_time(broker.pid) - cpu['broker']}
+    latencies = received[count:]
+    stop(logger)
+    stop(broker)
+    logfile.close()
+
+    print("pipeline: {} devices every {} s = {:.1f} samples/s expected".format(
+        len(devices), period, len(devices)/period))
+    if latencies:
+        report("logger -> broker -> client", latencies, elapsed, cpu['logger'])
+        print("{:<28s} CPU {:.0f}%".format("broker", 100*cpu['broker']/elapsed))
+    else:
+        print("no data received, see {}".format(os.path.join(work, 'logger.log')))
+        return
+    with open(os.path.join(work, 'logger.log')) as fo:
+        for line in fo:
+            if 'Device' in line or 'Port' in line or 'Publisher' in line:
+                print(line.split(':: ', 1)[-1].rstrip())
+    shutil.rmtree(work)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end benchmark on simulated slaves")
+    parser.add_argument('--devices', nargs='+', default=['falco:100'],
+                        help="register map and address of each simulated slave")
+    parser.add_argument('--period', type=float, default=0.05, help="polling period of each device")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of pipeline run")
+    parser.add_argument('--polls', type=int, default=500, help="readline() calls per transport")
+    parser.add_argument('--latency', type=float, default=0.002, help="answer delay of the slaves")
+    parser.add_argument('--transport', default='minimalmodbus',
+                        help="TRANSPORT of the logger ('minimalmodbus' or 'asyncio')")
+    args = parser.parse_args()
+
+    simulator, port = start_simulator(args.devices, args.latency)
+    try:
+        bench_transactions(port, args.devices, args.polls)
+        bench_pipeline(port, args.devices, args.period, args.duration, args.transport)
+    finally:
+        stop(simulator)
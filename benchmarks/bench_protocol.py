@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+#
+# Encode/decode throughput of the framed binary protocol (protocol.py)
+# compared with the former json text messages.
+#
+# usage: python benchmarks/bench_protocol.py [number of messages]
+
+import os, sys
+import time
+import json
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from protocol import Encoder, Decoder
+
+# typical Falco readline() output
+sample = [
+    {'var': 'VOC', 'val': 12.34, 'unit': 'ppm'},
+    {'var': 'Voltage', 'val': 1234.5, 'unit': 'mV'},
+    {'var': 'T', 'val': 23.5, 'unit': 'degC'},
+    {'var': 'RF', 'val': 1.0, 'unit': '-'},
+    {'var': 'Range', 'val': 50, 'unit': '-'}
+    ]
+
+def bench(label, function, n):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    print("{:<20s} {:>12.0f} msg/s  {:>8.2f} us/msg".format(label, n/elapsed, 1e6*elapsed/n))
+    return result
+
+def run(n):
+    now = time.time()
+
+    encoder = Encoder()
+    frames = bench("binary encode", lambda: [encoder.encode(sample, now) for _ in range(n)], n)
+    stream = b''.join(frames)
+    decoder = Decoder()
+    # decode in chunks as delivered by recv()
+    chunks = [stream[i:i+65536] for i in range(0, len(stream), 65536)]
+    bench("binary decode", lambda: [decoder.feed(c) for c in chunks], n)
+
+    texts = bench("json encode", lambda: [json.dumps(sample).encode() for _ in range(n)], n)
+    bench("json decode", lambda: [json.loads(t.decode()) for t in texts], n)
+
+    print("bytes per message: binary {:.1f}, json {:.1f}".format(
+        len(stream)/n, sum(len(t) for t in texts)/n))
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    run(n)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# Simulated Modbus RTU slaves on a pseudo terminal (Linux).
+#
+# The register contents are generated from the register maps in
+# drivers/maps, so every map (falco, smt100, ...) can be simulated. The
+# drivers open the printed pty name like a USB to RS485 adapter. Latency,
+# measurement noise and transmission errors can be configured to test the
+# logger without hardware.
+#
+# usage: python benchmarks/simulator.py falco:100 smt100:3 [--latency 0.005]
+#            [--noise 0.01] [--errors 0.01] [--drops 0.01] [--exceptions 0.01]
+
+import os, sys
+import pty
+import tty
+import time
+import struct
+import random
+import argparse
+import threading
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(repo_path)
+sys.path.append(os.path.join(repo_path, 'drivers'))
+from registers import RegisterMap
+from aio import crc16, add_crc
+
+# values of the simulated sensors (raw text for 'char' registers)
+DEFAULTS = {
+    'falco': {'VOC': 3.25, 'Voltage': 120.0, 'T': 21.5, 'LED': 1, 'Version': 100,
+              'Unit': 'p', 'RF': 1.0, 'Range': 50, 'Cal100': 100, 'Cal3000': 3000},
+    'smt100': {'T': 21.5, 'Moist': 20.0, 'Perm': 5, 'Count': 0},
+    }
+
+class SimulatedDevice(object):
+    """Register image of one slave built from a register map.
+
+    Args:
+        * register_map (str or RegisterMap): map name, path or object
+        * values (dict): var -> value (engineering units, text for 'char'
+          and 'string' registers). Missing variables are 0
+        * noise (float): relative standard deviation added to the live
+          numeric values on every request
+
+    Registers without a variable read as 0. Variables named 'Count' are
+    incremented on every request, so lost samples can be detected.
+    """
+
+    def __init__(self, register_map, values=None, noise=0.0):
+        if not isinstance(register_map, RegisterMap):
+            register_map = RegisterMap.load(register_map)
+        self.register_map = register_map
+        self.values = dict(values or {})
+        self.noise = noise
+        self.requests = 0
+
+    def encode(self, register, value):
+        """Return the raw registers of value"""
+        if register.type in ('char', 'string'):
+            text = str(value).encode('latin-1').ljust(2*register.count, b'\x00')
+            return list(struct.unpack('>' + 'H'*register.count, text[:2*register.count]))
+        if register.offset is not None:
+            value = value - register.offset
+        if register.scale is not None:
+            value = value/register.scale
+        if register.type == 'float':
+            return list(struct.unpack('>HH', struct.pack('>f', value)))
+        value = int(round(value))
+        if register.type == 'int16':
+            value = max(-0x8000, min(value, 0x7FFF)) & 0xFFFF
+        return [max(0, min(value, 0xFFFF))]
+
+    def read(self, start, count):
+        """Return count raw registers starting at start"""
+        self.requests += 1
+        if 'Count' in self.register_map.vars:
+            self.values['Count'] = self.requests
+
+        image = {}
+        for register in self.register_map.registers:
+            if register.end <= start or register.address >= start + count:
+                continue
+            value = self.values.get(register.var, 0)
+            if (self.noise and not register.static and register.type not in ('char', 'string')
+                    and register.var != 'Count'):
+                value = value*(1 + random.gauss(0, self.noise))
+            for i, raw in enumerate(self.encode(register, value)):
+                image[register.address + i] = raw
+
+        return [image.get(address, 0) for address in range(start, start + count)]
+
+class Simulator(threading.Thread):
+    """Modbus RTU slaves answering on a pseudo terminal.
+
+    Args:
+        * devices (dict): slave address -> SimulatedDevice
+        * latency (float): seconds between request and answer
+        * errors (float): probability of an answer with a wrong CRC
+        * drops (float): probability of no answer (timeout in the master)
+        * exceptions (float): probability of an exception response
+
+    Only read requests (function codes 3 and 4) are answered. Requests to
+    unknown addresses are ignored like on a real bus.
+    """
+
+    def __init__(self, devices, latency=0.002, errors=0.0, drops=0.0, exceptions=0.0):
+        threading.Thread.__init__(self, name='simulator', daemon=True)
+        self.devices = devices
+        self.latency = latency
+        self.errors = errors
+        self.drops = drops
+        self.exceptions = exceptions
+        self.master, slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self.slave = slave      # kept open so the pty survives reconnects
+
+        # statistics
+        self.answers = 0
+        self.injected = 0
+
+    def answer(self, request):
+        address, function, start, count = struct.unpack('>BBHH', request[:6])
+        device = self.devices.get(address)
+        if device is None:
+            return None
+
+        draw = random.random()
+        if draw < self.drops:
+            self.injected += 1
+            return None
+        if function not in (3, 4) or draw < self.drops + self.exceptions:
+            # illegal function or slave device failure
+            self.injected += function in (3, 4)
+            return add_crc(struct.pack('>BBB', address, function | 0x80,
+                                       4 if function in (3, 4) else 1))
+
+        data = struct.pack('>' + 'H'*count, *device.read(start, count))
+        response = add_crc(struct.pack('>BBB', address, function, len(data)) + data)
+        if draw < self.drops + self.exceptions + self.errors:
+            self.injected += 1
+            response = response[:-1] + bytes([response[-1] ^ 0xFF])
+        return response
+
+    def run(self):
+        buffer = b''
+        while 1:
+            try:
+                buffer += os.read(self.master, 256)
+            except OSError:
+                break   # closed
+            # read requests are 8 bytes: address, function, start, count, crc
+            while len(buffer) >= 8:
+                if crc16(buffer[:6]) != struct.unpack('<H', buffer[6:8])[0]:
+                    buffer = buffer[1:]     # resynchronize
+                    continue
+                request, buffer = buffer[:8], buffer[8:]
+                response = self.answer(request)
+                if response is None:
+                    continue
+                if self.latency:
+                    time.sleep(self.latency)
+                os.write(self.master, response)
+                self.answers += 1
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulated Modbus RTU slaves on a pty")
+    parser.add_argument('devices', nargs='+', help="register map and address, e.g. falco:100")
+    parser.add_argument('--latency', type=float, default=0.002, help="answer delay in seconds")
+    parser.add_argument('--noise', type=float, default=0.0, help="relative noise of the values")
+    parser.add_argument('--errors', type=float, default=0.0, help="probability of CRC errors")
+    parser.add_argument('--drops', type=float, default=0.0, help="probability of missing answers")
+    parser.add_argument('--exceptions', type=float, default=0.0,
+                        help="probability of exception responses")
+    args = parser.parse_args()
+
+    devices = {}
+    for spec in args.devices:
+        name, address = spec.split(':')
+        devices[int(address)] = SimulatedDevice(name, DEFAULTS.get(name), args.noise)
+
+    simulator = Simulator(devices, args.latency, args.errors, args.drops, args.exceptions)
+    simulator.start()
+    print(simulator.port, flush=True)
+    try:
+        while 1:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("{} answers, {} errors injected".format(simulator.answers, simulator.injected))
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#
+# Publish/subscribe server between logger.py and any number of viewers.
+#
+# logger.py connects to HOST_PORT and publishes its data frames (see
+# protocol.py). GUIs, archivers or alerting scripts connect to
+# SUBSCRIBE_PORT and receive the data of all publishers. Every subscriber
+# has its own bounded queue and sending thread: when a subscriber is too
+# slow its oldest samples are dropped, so viewers never slow down the
+# logger or the other viewers.
+
+import os, sys
+import time
+import queue
+import socket
+import threading
+import configparser
+
+from utils import log_message, log_exception
+from protocol import Encoder, Decoder
+
+# path where the config.ini file is located
+base_path = os.path.abspath(os.path.dirname(sys.argv[0]))
+
+class Subscriber(threading.Thread):
+    """Connection of one subscriber with its own send queue.
+
+    Args:
+        * connection (socket): connected socket
+        * address: address of the subscriber
+        * maxsize (int): samples kept for a slow subscriber before dropping
+    """
+
+    def __init__(self, connection, address, maxsize):
+        threading.Thread.__init__(self, name='subscriber {}'.format(address), daemon=True)
+        self.connection = connection
+        self.address = address
+        self.queue = queue.Queue(maxsize)
+        self.encoder = Encoder()     # sends the schemas again to every subscriber
+        self.dropped = 0
+        self.closed = False
+
+    def push(self, timestamp, data):
+        """Queue one sample. Drops the oldest sample if the queue is full"""
+        self._put((timestamp, data))
+
+    def _put(self, item):
+        while 1:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        """Stop the thread without blocking, also when the queue is full or a
+        send to a stalled subscriber is pending"""
+        if self.closed:
+            return
+        self.closed = True
+        self._put(None)
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)  # ends a blocked sendall()
+        except OSError:
+            pass
+
+    def run(self):
+        try:
+            while not self.closed:
+                item = self.queue.get()
+                if item is None:
+                    break
+                # send everything waiting in one call
+                payload = [self.encoder.encode(item[1], item[0])]
+                while 1:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        self.closed = True
+                        break
+                    payload.append(self.encoder.encode(item[1], item[0]))
+                self.connection.sendall(b''.join(payload))
+        except socket.error:
+            log_message("BROKER", "subscriber {} disconnected".format(self.address))
+        finally:
+            self.closed = True
+            self.connection.close()
+            if self.dropped:
+                log_message("BROKER", "{} samples dropped for slow subscriber {}".format(
+                    self.dropped, self.address))
+
+class Broker(object):
+    """Accepts publishers and subscribers and forwards the data.
+
+    Args:
+        * host_name (str): address to listen on
+        * publish_port (int): port for publishers (logger.py)
+        * subscribe_port (int): port for subscribers (gui.py, ...)
+        * maxsize (int): send queue length of each subscriber
+    """
+
+    def __init__(self, host_name, publish_port, subscribe_port, maxsize=1000):
+        self.maxsize = maxsize
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.sockets = [self.listen(host_name, publish_port, self.add_publisher),
+                        self.listen(host_name, subscribe_port, self.add_subscriber)]
+
+    def listen(self, host_name, port, handler):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host_name, port))
+        sock.listen(5)
+        log_message("BROKER", 'listening on {}'.format((host_name, port)))
+        threading.Thread(target=self.accept, args=(sock, handler), daemon=True).start()
+        return sock
+
+    def accept(self, sock, handler):
+        while 1:
+            try:
+                connection, address = sock.accept()
+            except OSError:
+                break   # listening socket closed
+            handler(connection, address)
+
+    def add_subscriber(self, connection, address):
+        log_message("BROKER", 'subscriber {}'.format(address))
+        subscriber = Subscriber(connection, address, self.maxsize)
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if not s.closed]
+            self.subscribers.append(subscriber)
+        subscriber.start()
+
+    def add_publisher(self, connection, address):
+        log_message("BROKER", 'publisher {}'.format(address))
+        threading.Thread(target=self.read_publisher, args=(connection, address),
+                         daemon=True).start()
+
+    def read_publisher(self, connection, address):
+        decoder = Decoder()
+        try:
+            while 1:
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                for timestamp, data in decoder.feed(chunk):
+                    self.publish(timestamp, data)
+        except socket.error:
+            pass
+        except:
+            log_exception("BROKER", "invalid data from publisher {}".format(address))
+        log_message("BROKER", "publisher {} disconnected".format(address))
+        connection.close()
+
+    def publish(self, timestamp, data):
+        """Forward one sample to all subscribers"""
+        with self.lock:
+            subscribers = self.subscribers
+        for subscriber in subscribers:
+            if not subscriber.closed:
+                subscriber.push(timestamp, data)
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+        with self.lock:
+            for subscriber in self.subscribers:
+                if not subscriber.closed:
+                    subscriber.close()
+
+def subscribe(server_address, retry=1):
+    """Yield (timestamp, data) tuples received from a broker.
+
+    Reconnects every retry seconds when the broker is not available.
+    Example for an archiver or alerting script:
+
+        for timestamp, data in subscribe(('127.0.0.1', 10001)):
+            ...
+    """
+    while 1:
+        try:
+            sock = socket.create_connection(server_address)
+        except socket.error:
+            time.sleep(retry)
+            continue
+        decoder = Decoder()
+        try:
+            while 1:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                for message in decoder.feed(chunk):
+                    yield message
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+
+if __name__ == '__main__':
+    # READ ini file
+    config_file = base_path + '/config.ini'
+    if os.path.exists(config_file):
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        host_name      = eval(config['TCP_INTERFACE']['HOST_NAME'])
+        host_port      = eval(config['TCP_INTERFACE']['HOST_PORT'])
+        subscribe_port = eval(config['TCP_INTERFACE'].get('SUBSCRIBE_PORT', '10001'))
+        maxsize        = eval(config['TCP_INTERFACE'].get('SEND_QUEUE', '1000'))
+    else:
+        log_message("BROKER", "Could not find the configuration file: {}".format(config_file))
+        exit()
+
+    broker = Broker(host_name, host_port, subscribe_port, maxsize)
+    try:
+        while 1:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        log_message("BROKER", "aborted by user!")
+        broker.close()
+        log_message("BROKER", "bye...")
@@ -0,0 +1,198 @@
+import numpy as np
+
+# Data buffers for the GUI.
+
+def to_float(value):
+    """Return value as float, NaN for values without a numeric meaning"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def forward_fill(values, present):
+    """Return values with the entries where present is False replaced by the
+    last entry where it is True (NaN before the first one)"""
+    index = np.where(present, np.arange(len(values)), -1)
+    index = np.maximum.accumulate(index)
+    filled = values[np.maximum(index, 0)]
+    filled[index < 0] = np.nan
+    return filled
+
+class RingBuffer(object):
+    """Fixed size circular buffer with one float column per variable.
+
+    Args:
+        * size (int): number of samples kept
+        * columns (list): variable names
+
+    The memory is allocated once. Every value is stored twice (at slot i
+    and i + size) so that the samples in time order are always a contiguous
+    slice: view() returns a numpy view without copying, and appending
+    costs the same whatever the buffer size.
+    """
+
+    def __init__(self, size, columns):
+        self.size = size
+        self.columns = list(columns)
+        self.index = {c: i for i, c in enumerate(self.columns)}
+        self.data = np.full((len(self.columns), 2*size), np.nan)
+        self.pos = 0        # next slot to write
+        self.count = 0      # number of valid samples
+        self.total = 0      # number of samples appended since the start
+
+    def __len__(self):
+        return self.count
+
+    def append(self, values):
+        """Add one sample given as a dictionary column -> value"""
+        for column, value in values.items():
+            i = self.index.get(column)
+            if i is not None:
+                value = to_float(value)
+                self.data[i, self.pos] = value
+                self.data[i, self.pos + self.size] = value
+        self.pos = (self.pos + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.total += 1
+
+    def extend(self, values):
+        """Add several samples given as a dictionary column -> sequence of values
+
+        All sequences must have the same length. Only the last size samples
+        are kept when more are given.
+        """
+        n = len(next(iter(values.values())))
+        if n == 0:
+            return
+        start = max(n - self.size, 0)
+        slots = (self.pos + np.arange(start, n)) % self.size
+        for column, sequence in values.items():
+            i = self.index.get(column)
+            if i is not None:
+                try:
+                    block = np.array(sequence[start:], dtype=float)
+                except (TypeError, ValueError):
+                    # text values are stored as NaN like in append()
+                    block = np.array([to_float(value) for value in sequence[start:]])
+                self.data[i, slots] = block
+                self.data[i, slots + self.size] = block
+        self.pos = (self.pos + n) % self.size
+        self.count = min(self.count + n, self.size)
+        self.total += n
+
+    def view(self, column):
+        """Return the valid samples of column (oldest first) as a numpy view"""
+        end = self.pos + self.size
+        return self.data[self.index[column], end - self.count:end]
+
+
+    def take(self, start, end):
+        """Return the samples start to end-1 (counted since the start) of all columns"""
+        return self.data[:, np.arange(start, end) % self.size]
+
+class Level(object):
+    """One decimation level: min and max of every column per bucket of samples"""
+
+    def __init__(self, bucket, columns, length):
+        self.bucket = bucket        # samples per bucket
+        self.length = length        # buckets kept
+        self.lo = np.full((columns, length), np.nan)
+        self.hi = np.full((columns, length), np.nan)
+
+    def take(self, start, end):
+        """Return (min, max) of the buckets start to end-1 (counted since the start)"""
+        slots = np.arange(start, end) % self.length
+        return self.lo[:, slots], self.hi[:, slots]
+
+    def store(self, start, lo, hi):
+        slots = np.arange(start, start + lo.shape[1]) % self.length
+        self.lo[:, slots] = lo
+        self.hi[:, slots] = hi
+
+class MinMaxPyramid(object):
+    """Min/max decimation of a RingBuffer for plotting long histories.
+
+    Args:
+        * buffer (RingBuffer): buffer with the samples
+        * time_column (str): column with the (increasing) sample times
+        * factor (int): samples per bucket of the first level, each further
+          level groups factor buckets of the level below
+        * min_buckets (int): no levels with fewer buckets are created
+
+    update() has to be called after new samples were added to the buffer.
+    Only the buckets touched by the new samples are recomputed, each level
+    from the level below, so the cost does not depend on the buffer size.
+    select() returns the points of a column for a time range: the raw
+    samples when they fit in the plot width, otherwise the minimum and
+    maximum of each bucket of the coarsest level that still gives one
+    bucket per pixel. Peaks are kept whatever the zoom.
+    """
+
+    def __init__(self, buffer, time_column, factor=4, min_buckets=64):
+        self.buffer = buffer
+        self.time = buffer.index[time_column]
+        self.factor = factor
+        self.done = 0       # samples of the buffer already in the levels
+        self.levels = []
+        bucket = factor
+        while buffer.size // bucket >= min_buckets:
+            self.levels.append(Level(bucket, len(buffer.columns), buffer.size // bucket + 2))
+            bucket *= factor
+
+    def update(self):
+        """Add the samples appended to the buffer since the last call"""
+        end = self.buffer.total
+        start = max(self.done, end - len(self.buffer))
+        if start >= end:
+            return
+        oldest = end - len(self.buffer)
+        source = None
+        for level in self.levels:
+            # first and last bucket touched by the new items of the level below
+            first = start // self.factor
+            last = (end - 1) // self.factor + 1
+            begin = max(first*self.factor, oldest)
+            if source is None:
+                lo = hi = self.buffer.take(begin, end)
+            else:
+                lo, hi = source.take(begin, end)
+            boundaries = np.maximum(np.arange(first, last)*self.factor - begin, 0)
+            level.store(first, np.fmin.reduceat(lo, boundaries, axis=1),
+                        np.fmax.reduceat(hi, boundaries, axis=1))
+            source = level
+            start, end, oldest = first, last, last - level.length
+        self.done = self.buffer.total
+
+    def select(self, column, x0=None, x1=None, width=None):
+        """Return (x, y) arrays of column to plot.
+
+        Args:
+            * column (str): column name
+            * x0, x1 (float): visible time range, None for all the samples
+            * width (int): plot width in pixels, None for no decimation
+        """
+        t = self.buffer.view(self.buffer.columns[self.time])
+        y = self.buffer.view(column)
+        i0, i1 = 0, len(t)
+        if x0 is not None and x1 is not None:
+            # one sample more on each side so the curve reaches the borders
+            i0 = max(np.searchsorted(t, x0, 'left') - 1, 0)
+            i1 = min(np.searchsorted(t, x1, 'right') + 1, len(t))
+        n = i1 - i0
+        if not width or not self.levels or n <= 2*width:
+            return t[i0:i1], y[i0:i1]
+
+        for level in self.levels:
+            if n <= level.bucket*width:
+                break
+        base = self.buffer.total - len(self.buffer)
+        # skip the oldest bucket when part of it already left the buffer
+        first = max((base + i0) // level.bucket, -(-base // level.bucket))
+        last = (base + i1 - 1) // level.bucket + 1
+        lo, hi = level.take(first, last)
+        column = self.buffer.index[column]
+        x = np.repeat(lo[self.time], 2)
+        y = np.empty(len(x))
+        y[0::2] = lo[column]
+        y[1::2] = hi[column]
+        return x, y
@@ -0,0 +1,341 @@
+import math
+import time
+import asyncio
+import threading
+
+from utils import log_message, log_exception
+from metrics import metrics
+
+# Polling of several instruments sharing one RS485 bus.
+#
+# Each Device has its own polling period. The BusScheduler always polls the
+# device with the earliest due time, so the transactions of all devices are
+# interleaved on the bus (one at a time, see drivers/ports.py) and every
+# device keeps its own rate. Every bus (serial port) is polled by its own
+# AcquisitionWorker thread, so several adapters are read in parallel.
+# AsyncBusScheduler does the same for the asyncio drivers (drivers/aio.py).
+#
+# The due times are absolute deadlines start + k*period (see Deadline), so
+# the sampling cadence does not drift with the time needed by readline().
+#
+# A device that stops answering must not slow down the others on its bus:
+# after a few failed polls its CircuitBreaker opens and the device is only
+# probed every few seconds until it answers again. Every failed poll is
+# sent on as a gap (all numeric values NaN), so plots and datafiles show
+# where data is missing.
+
+class Deadline(object):
+    """Fixed cadence of absolute deadlines.
+
+    Args:
+        * period (float): seconds between deadlines
+        * start (float): time.monotonic() of the first deadline (default now)
+
+    Slots that have already passed when a poll ends are skipped and counted
+    as missed instead of being polled late. A period of 0 (or less) polls
+    continuously: the next deadline is always the end of the last poll.
+    """
+
+    def __init__(self, period, start=None):
+        self.period = period
+        self.start = time.monotonic() if start is None else start
+        self.slot = 0
+
+        # counters
+        self.polls = 0
+        self.missed = 0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+
+    @property
+    def due(self):
+        """time.monotonic() of the current deadline"""
+        return self.start + self.slot*self.period
+
+    def begin(self, now):
+        """Record the jitter (delay after the deadline) of a poll starting at now"""
+        jitter = max(now - self.due, 0.0)
+        self.polls += 1
+        self.jitter_sum += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+
+    def advance(self, now):
+        """Move to the next deadline after now. Return the number of missed slots"""
+        if self.period <= 0:
+            self.start, self.slot = now, 0
+            return 0
+        self.slot += 1
+        skipped = 0
+        if self.due <= now:
+            skipped = int((now - self.due)//self.period) + 1
+            self.slot += skipped
+            self.missed += skipped
+        return skipped
+
+    def skip(self, until):
+        """Move to the first deadline at or after until without counting missed slots"""
+        if self.period <= 0:
+            self.start, self.slot = until, 0
+            return
+        self.slot = max(self.slot, math.ceil((until - self.start)/self.period))
+
+    def stats(self):
+        """Return a dictionary with the jitter and overrun counters"""
+        return {'polls': self.polls,
+                'missed': self.missed,
+                'jitter_mean': self.jitter_sum/self.polls if self.polls else 0.0,
+                'jitter_max': self.jitter_max}
+
+def device_name(entry):
+    """Return the name (also used for the datafiles) of a DEVICES entry"""
+    return entry.get('name', '{}-{}'.format(entry['driver'], entry['address']))
+
+# failed polls (or polls that overran their slot) of a device between two
+# log messages. The totals are in the metrics and the exit summary
+LOG_FAILURES = 100
+
+class CircuitBreaker(object):
+    """Health of one device.
+
+    Args:
+        * threshold (int): consecutive failed polls that open the breaker
+        * probe (float): seconds between polls while the breaker is open
+
+    A closed breaker polls the device at its own period. An open breaker
+    only lets a probe through every probe seconds, a successful probe
+    closes it again. A device that never answered is probed after its
+    first failure already.
+    """
+
+    def __init__(self, threshold=3, probe=10):
+        self.threshold = threshold
+        self.probe = probe
+        self.failures = 0       # consecutive failed polls
+        self.open = False
+        self.trips = 0
+        self.answered = False   # at least one successful poll
+
+    def failure(self):
+        """Count a failed poll. Return True when the breaker opens"""
+        self.failures += 1
+        threshold = self.threshold if self.answered else 1
+        if not self.open and self.failures >= threshold:
+            self.open = True
+            self.trips += 1
+            return True
+        return False
+
+    def success(self):
+        """Reset after a successful poll. Return the number of failures before"""
+        failures = self.failures
+        self.failures = 0
+        self.answered = True
+        self.open = False
+        return failures
+
+class Device(object):
+    """Instrument polled periodically.
+
+    Args:
+        * instrument: driver object providing readline()
+        * name (str): device name (used e.g. for the data file name)
+        * period (float): polling period in seconds
+        * prefix (str): prefix added to the variable names sent to the GUI
+        * threshold (int): consecutive failed polls before the device is
+          only probed (see CircuitBreaker)
+        * probe (float): seconds between probes of a failed device
+
+    poll() does not raise when the instrument fails. It returns a gap
+    (the last data with NaN values) or None before the first success.
+    """
+
+    def __init__(self, instrument, name, period, prefix='', threshold=3, probe=10):
+        self.instrument = instrument
+        self.name = name
+        self.period = period
+        self.prefix = prefix
+        self.deadline = Deadline(period)
+        self.overruns = 0       # polls that missed sampling slots
+        self.breaker = CircuitBreaker(threshold, max(probe, period))
+        self.last = None        # data of the last successful poll
+
+    @property
+    def next_due(self):
+        return self.deadline.due
+
+    def schedule(self):
+        """Move to the next deadline, flagging missed sampling slots"""
+        now = time.monotonic()
+        if self.breaker.open:
+            # probe on the sampling grid, the slots in between are not missed
+            self.deadline.skip(now + self.breaker.probe)
+            return
+        skipped = self.deadline.advance(now)
+        if skipped:
+            metrics.count('bus.missed_slots', skipped)
+            self.overruns += 1
+            if self.overruns % LOG_FAILURES == 1:
+                log_message("LOGGER", "'{}' missed {} sampling slot(s), {} in total".format(
+                    self.name, skipped, self.deadline.missed))
+
+    def poll(self):
+        """Return the current data of the device (or a gap) and schedule the next poll"""
+        self.deadline.begin(time.monotonic())
+        try:
+            with metrics.timer('poll.' + self.name):
+                data = self.instrument.readline()
+        except Exception:
+            return self.failed()
+        else:
+            return self.recovered(data)
+        finally:
+            self.schedule()
+
+    async def poll_async(self):
+        """Same as poll() for drivers with an await-able readline()"""
+        self.deadline.begin(time.monotonic())
+        try:
+            with metrics.timer('poll.' + self.name):
+                data = await self.instrument.readline()
+        except Exception:
+            return self.failed()
+        else:
+            return self.recovered(data)
+        finally:
+            self.schedule()
+
+    def failed(self):
+        # called in the except block of a failed poll. Return the gap
+        metrics.count('bus.poll_errors')
+        breaker = self.breaker
+        if breaker.failure():
+            metrics.count('bus.breaker_trips')
+            if hasattr(self.instrument, 'probing'):
+                self.instrument.probing = True   # probes are not retried
+            log_message("LOGGER", "'{}' failed {} time(s) in a row, probing every {} s".format(
+                self.name, breaker.failures, breaker.probe))
+        if breaker.failures % LOG_FAILURES == 1:
+            log_exception("LOGGER", "'{}' failed {} time(s) in a row".format(
+                self.name, breaker.failures))
+        return self.gap()
+
+    def recovered(self, data):
+        # called after a successful poll. Return data
+        failures = self.breaker.success()
+        if hasattr(self.instrument, 'probing'):
+            self.instrument.probing = False
+        if failures:
+            log_message("LOGGER", "'{}' answers again after {} failed poll(s)".format(
+                self.name, failures))
+            if failures >= self.breaker.threshold and hasattr(self.instrument, 'invalidate'):
+                # the sensor may have been replaced or reconfigured meanwhile
+                self.instrument.invalidate()
+        self.last = data
+        return data
+
+    def gap(self):
+        """Return the last data with NaN for all numeric values (None before the first poll)"""
+        if self.last is None:
+            return None
+        return [dict(dic, val=float('nan')) if isinstance(dic['val'], (int, float))
+                and not isinstance(dic['val'], bool) else dic for dic in self.last]
+
+    def stats(self):
+        """Return the jitter, overrun and failure counters of the device"""
+        return dict(self.deadline.stats(), name=self.name, trips=self.breaker.trips,
+                    failing=self.breaker.open)
+
+    def tag(self, data):
+        """Return data with the device prefix added to the variable names"""
+        if not self.prefix:
+            return data
+        return [dict(dic, var=self.prefix + dic['var']) for dic in data]
+
+class BusScheduler(object):
+    """Interleaves the polls of several devices on one bus.
+
+    Args:
+        * devices (list): Device objects
+    """
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.current = None     # device being polled (for error messages)
+
+    def next_device(self):
+        """Return the device with the earliest due time"""
+        return min(self.devices, key=lambda d: d.next_due)
+
+    def poll(self):
+        """Wait for the next due device, poll it and return (device, data)"""
+        device = self.current = self.next_device()
+        delay = device.next_due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return device, device.poll()
+
+class AcquisitionWorker(threading.Thread):
+    """Thread polling all the devices of one bus.
+
+    Args:
+        * port (str): port name (used for messages and the thread name)
+        * devices (list): Device objects on this port
+        * output (queue.Queue): receives (timestamp, device, data) tuples
+    """
+
+    def __init__(self, port, devices, output):
+        threading.Thread.__init__(self, name=port, daemon=True)
+        self.port = port
+        self.scheduler = BusScheduler(devices)
+        self.output = output
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        # failing devices are handled by Device.poll(), the other devices
+        # on the bus keep their rate
+        while not self.stopped.is_set():
+            try:
+                device, data = self.scheduler.poll()
+                if data is not None:
+                    self.output.put((time.time(), device, data))
+            except:
+                log_exception("LOGGER", "something went wrong on {}... Waiting 5 seconds...".format(
+                    self.port))
+                self.stopped.wait(5)
+
+class AsyncBusScheduler(BusScheduler):
+    """BusScheduler for devices using the asyncio drivers.
+
+    Args:
+        * port (str): port name (used for messages)
+        * devices (list): Device objects with asyncio instruments
+    """
+
+    def __init__(self, port, devices):
+        BusScheduler.__init__(self, devices)
+        self.port = port
+
+    async def poll(self):
+        """Wait for the next due device, poll it and return (device, data)"""
+        device = self.current = self.next_device()
+        delay = device.next_due - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return device, await device.poll_async()
+
+    async def run(self, output):
+        """Poll forever putting (timestamp, device, data) on output (asyncio.Queue)"""
+        while True:
+            try:
+                device, data = await self.poll()
+                if data is not None:
+                    await output.put((time.time(), device, data))
+            except asyncio.CancelledError:
+                raise
+            except:
+                log_exception("LOGGER", "something went wrong on {}... Waiting 5 seconds...".format(
+                    self.port))
+                await asyncio.sleep(5)
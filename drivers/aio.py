@@ -0,0 +1,318 @@
+import time
+import struct
+import asyncio
+import serial
+
+from registers import RegisterMap, RegisterCache, decode_float, decode_signed, decode_string
+from timing import AdaptiveTimeout, RetryPolicy
+from metrics import metrics
+from utils import log_message
+
+# asyncio based Modbus RTU transport.
+#
+# The serial port is opened in non blocking mode and watched by the event
+# loop (loop.add_reader), so waiting for a slow or dead device does not
+# block other coroutines (other ports, TCP publishing, file writing).
+# Only function code 3/4 register reads are implemented, which is all the
+# register map drivers need.
+
+def crc16(data):
+    """Return the Modbus CRC16 of data (bytes) as int"""
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+    return crc
+
+def add_crc(frame):
+    """Return frame with its CRC appended (low byte first)"""
+    return frame + struct.pack('<H', crc16(frame))
+
+def check_crc(frame):
+    """Return True if the last two bytes of frame are its valid CRC"""
+    return len(frame) > 2 and struct.unpack('<H', frame[-2:])[0] == crc16(frame[:-2])
+
+class ModbusError(IOError):
+    """Exception response, timeout or corrupt answer from a slave"""
+
+class NoResponseError(ModbusError):
+    """No (complete) answer within the timeout"""
+
+class InvalidResponseError(ModbusError):
+    """Answer with a wrong CRC or from the wrong slave"""
+
+class SlaveReportedError(ModbusError):
+    """Exception response of the slave"""
+
+class SlaveDeviceBusyError(SlaveReportedError):
+    """Exception code 6: the slave is processing a long command"""
+
+class AsyncRTUTransport(object):
+    """Modbus RTU master on one serial port for use with asyncio.
+
+    Args:
+        * portname (str): port name
+        * baudrate, bytesize, parity, stopbits: serial settings
+        * timeout (float): seconds to wait for a response
+
+    All transactions on the port are serialized with an asyncio.Lock.
+    When the adapter fails (e.g. it was unplugged) the port is closed and
+    the next transaction opens it again.
+    """
+
+    def __init__(self, portname, baudrate=9600, bytesize=8, parity=serial.PARITY_NONE,
+                 stopbits=1, timeout=1):
+        self.portname = portname
+        self.settings = {'baudrate': baudrate, 'bytesize': bytesize,
+                         'parity': parity, 'stopbits': stopbits}
+        self.timeout = timeout
+        self.serial = None
+        self.lock = None
+        self.buffer = bytearray()
+        self.data_ready = None
+        self.lost = False       # closed after an error of the adapter
+        self.received = 0       # bytes received since the start
+
+        # silent interval between frames (3.5 characters of 11 bits)
+        self.frame_gap = max(3.5*11/baudrate, 0.00175)
+
+    @classmethod
+    def from_map(cls, portname, register_map):
+        """Return a transport with the serial settings of a register map (name, path or object)"""
+        if not isinstance(register_map, RegisterMap):
+            register_map = RegisterMap.load(register_map)
+        return cls(portname, **register_map.serial)
+
+    async def open(self):
+        """Open the port and register it with the running event loop"""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+            self.data_ready = asyncio.Event()
+        self.serial = serial.Serial(self.portname, timeout=0, **self.settings)
+        asyncio.get_running_loop().add_reader(self.serial.fileno(), self._on_readable)
+        if self.lost:
+            self.lost = False
+            metrics.count('serial.reopens')
+
+    def close(self):
+        if self.serial is not None:
+            asyncio.get_running_loop().remove_reader(self.serial.fileno())
+            self.serial.close()
+            self.serial = None
+
+    def _drop(self):
+        # close the port after an error of the adapter. A pending read
+        # runs into its timeout and the next transaction reopens the port
+        try:
+            asyncio.get_running_loop().remove_reader(self.serial.fileno())
+        except (ValueError, OSError):
+            pass
+        try:
+            self.serial.close()
+        except (serial.SerialException, OSError):
+            pass
+        self.serial = None
+        self.lost = True
+
+    def _on_readable(self):
+        try:
+            data = self.serial.read(self.serial.in_waiting or 1)
+        except (serial.SerialException, OSError):
+            self._drop()
+            return
+        self.buffer.extend(data)
+        self.received += len(data)
+        self.data_ready.set()
+
+    async def _read(self, number_of_bytes):
+        while len(self.buffer) < number_of_bytes:
+            self.data_ready.clear()
+            await self.data_ready.wait()
+        data = bytes(self.buffer[:number_of_bytes])
+        del self.buffer[:number_of_bytes]
+        return data
+
+    async def _read_response(self, functioncode, number_of_bytes):
+        header = await self._read(2)
+        if header[1] == functioncode | 0x80:
+            # exception response: slave, function, code, crc
+            return header + await self._read(3)
+        return header + await self._read(number_of_bytes - 2)
+
+    async def transaction(self, slaveaddress, pdu, number_of_bytes, timing=None, attempt=0):
+        """Send pdu to slaveaddress and return the response payload.
+
+        number_of_bytes is the expected response length including the
+        address, function code and CRC. timing (timing.AdaptiveTimeout)
+        gives the timeout of the slave instead of self.timeout and learns
+        from the roundtrip time, attempt counts the retries.
+        """
+        if self.serial is None:
+            await self.open()
+        with metrics.timer('modbus.transaction'):
+            return await self._transaction(slaveaddress, pdu, number_of_bytes, timing, attempt)
+
+    async def _transaction(self, slaveaddress, pdu, number_of_bytes, timing, attempt):
+        request = add_crc(struct.pack('>B', slaveaddress) + pdu)
+        async with self.lock:
+            if timing is None:
+                timeout = self.timeout
+            else:
+                timeout = timing.timeout(len(request), number_of_bytes, attempt)
+            if self.serial is None:
+                await self.open()   # dropped while waiting for the lock
+            self.buffer.clear()
+            received = self.received
+            start = time.perf_counter()
+            try:
+                self.serial.reset_input_buffer()
+                self.serial.write(request)
+            except (serial.SerialException, OSError):
+                self._drop()
+                raise
+            try:
+                response = await asyncio.wait_for(
+                    self._read_response(pdu[0], number_of_bytes), timeout)
+                if timing is not None and len(response) == number_of_bytes:
+                    timing.observe(time.perf_counter() - start, len(request), number_of_bytes)
+            except asyncio.TimeoutError:
+                metrics.count('modbus.timeouts')
+                if timing is not None and self.received == received:
+                    timing.expired()
+                raise NoResponseError("No answer from address {} on {}".format(
+                    slaveaddress, self.portname))
+            finally:
+                await asyncio.sleep(self.frame_gap)
+
+        if not check_crc(response):
+            metrics.count('modbus.crc_errors')
+            raise InvalidResponseError("CRC error in answer from address {}".format(slaveaddress))
+        if response[0] != slaveaddress:
+            metrics.count('modbus.invalid_responses')
+            raise InvalidResponseError("Answer from wrong address {} instead of {}".format(
+                response[0], slaveaddress))
+        if response[1] & 0x80:
+            metrics.count('modbus.exceptions')
+            error = SlaveDeviceBusyError if response[2] == 6 else SlaveReportedError
+            raise error("Address {} returned exception code {}".format(
+                slaveaddress, response[2]))
+        return response[2:-2]
+
+    async def read_registers(self, slaveaddress, registeraddress, number_of_registers,
+                             functioncode=3, timing=None, attempt=0):
+        """Return a list of number_of_registers 16 bit unsigned ints"""
+        pdu = struct.pack('>BHH', functioncode, registeraddress, number_of_registers)
+        payload = await self.transaction(slaveaddress, pdu, 5 + 2*number_of_registers,
+                                         timing, attempt)
+        return list(struct.unpack('>' + 'H'*number_of_registers, payload[1:]))
+
+    async def read_register(self, slaveaddress, registeraddress, number_of_decimals=0,
+                            functioncode=3, signed=False):
+        """Return one register (see minimalmodbus.Instrument.read_register)"""
+        registers = await self.read_registers(slaveaddress, registeraddress, 1, functioncode)
+        if signed:
+            value = decode_signed(registers, 0)
+        else:
+            value = registers[0]
+        if number_of_decimals:
+            value = value/10.0**number_of_decimals
+        return value
+
+    async def read_float(self, slaveaddress, registeraddress, functioncode=3):
+        """Return a 32 bit float stored in two registers"""
+        registers = await self.read_registers(slaveaddress, registeraddress, 2, functioncode)
+        return decode_float(registers, 0)
+
+    async def read_string(self, slaveaddress, registeraddress, number_of_registers=16,
+                          functioncode=3):
+        """Return a string stored in number_of_registers registers"""
+        registers = await self.read_registers(slaveaddress, registeraddress,
+                                              number_of_registers, functioncode)
+        return decode_string(registers, 0, number_of_registers)
+
+class AsyncRegisterMapDevice(object):
+    """Register map driver on top of an AsyncRTUTransport.
+
+    Same behaviour as registers.RegisterMapInstrument (block reads, cached
+    static registers) with await-able get() and readline().
+
+    Args:
+        * transport (AsyncRTUTransport): transport of the bus
+        * slaveaddress (int): slave address in the range 1 to 247
+        * register_map (str or RegisterMap): map name, path or object
+        * static_refresh (float): seconds between readings of the static registers
+        * retries (int): repetitions of a read after a timeout or a corrupt answer
+        * adaptive_timeout (bool): derive the response timeout from the serial
+          settings and the observed latency (see timing.py)
+        * periods (dict): var -> seconds between readings of slow variables
+    """
+
+    def __init__(self, transport, slaveaddress, register_map, static_refresh=600,
+                 retries=2, adaptive_timeout=True, periods=None):
+        if not isinstance(register_map, RegisterMap):
+            register_map = RegisterMap.load(register_map)
+        self.register_map = register_map
+        self.transport = transport
+        self.address = slaveaddress
+
+        # all devices on a bus must use the same settings (see ports.py)
+        differ = {key: value for key, value in register_map.serial.items()
+                  if key in transport.settings and transport.settings[key] != value}
+        if differ:
+            log_message("LOGGER", "Serial settings {} of address {} differ from {} used on port {}".format(
+                differ, slaveaddress, transport.settings, transport.portname))
+
+        self.cache = RegisterCache(self.register_map, static_refresh, periods)
+
+        self.retry = RetryPolicy(retries)
+        self.probing = False    # set by bus.Device while the device is failing: no retries
+        if adaptive_timeout:
+            self.timing = AdaptiveTimeout(max_timeout=transport.timeout, **transport.settings)
+        else:
+            self.timing = None
+
+    async def read_block(self, block):
+        """Return the raw registers of block, retrying timeouts and corrupt answers"""
+        retries = 0 if self.probing else self.retry.retries
+        for attempt in range(retries + 1):
+            try:
+                return await self.transport.read_registers(self.address, block.start,
+                                                           block.count, timing=self.timing,
+                                                           attempt=attempt)
+            except (NoResponseError, InvalidResponseError, SlaveDeviceBusyError):
+                if attempt == retries:
+                    raise
+            metrics.count('modbus.retries')
+            await asyncio.sleep(self.retry.delay(attempt))
+
+    async def read_blocks(self, blocks):
+        """Return a dictionary var -> value reading each block once"""
+        values = {}
+        for block in blocks:
+            values.update(block.decode(await self.read_block(block)))
+        return values
+
+    def invalidate(self):
+        """Force a new reading of the static and slow registers on the next access"""
+        self.cache.invalidate()
+
+    async def update(self, static_only=False):
+        """Read the register groups whose period elapsed and return all the values"""
+        for group in self.cache.due(static_only):
+            self.cache.store(group, await self.read_blocks(group.blocks))
+        return self.cache.values()
+
+    async def get(self, var):
+        """Return the current value of a single variable"""
+        register = self.register_map.vars[var]
+        if register.static:
+            return (await self.update(static_only=True))[var]
+        return (await self.read_blocks(self.register_map.plan([register])))[var]
+
+    async def readline(self):
+        """Return a list of dictionaries with current data (see RegisterMapInstrument)"""
+        return self.register_map.response(await self.update())
@@ -1,104 +1,78 @@
-import minimalmodbus
+from registers import RegisterMapInstrument
+from aio import AsyncRegisterMapDevice
 
-class Falco( minimalmodbus.Instrument ):
+class Falco( RegisterMapInstrument ):
     """Instrument class for ION Falco VOC Measurement Device.
 
+    The registers are described in maps/falco.json.
+
     Args:
         * portname (str): port name
         * slaveaddress (int): slave address in the range 1 to 247
+        * static_refresh (float): seconds between readings of the static registers
+        * periods (dict): var -> seconds between readings of slow variables
 
     """
 
-    def __init__(self, portname, slaveaddress):
-        minimalmodbus.Instrument.__init__(self, portname, slaveaddress,
-                                          mode=minimalmodbus.MODE_RTU)
-        
-        #Make the settings explicit
-        self.serial.baudrate = 9600        # Baud
-        self.serial.bytesize = 8
-        self.serial.parity   = minimalmodbus.serial.PARITY_NONE
-        self.serial.stopbits = 1
-        self.serial.timeout  = 1          # seconds
-
-        # Good practice
-        self.close_port_after_each_call = True
-        self.clear_buffers_before_each_transaction = True
+    def __init__(self, portname, slaveaddress, static_refresh=600, periods=None):
+        RegisterMapInstrument.__init__(self, portname, slaveaddress, 'falco',
+                                       static_refresh=static_refresh, periods=periods)
 
     def get_voc(self):
         """Return the Gas concentration. 32 bit float, 2 Registers"""
-        return self.read_float(102)
+        return self.get('VOC')
 
     def get_voltage(self):
         """Return the sensor voltage in mV. 32 bit float, 2 Registers"""
-        return self.read_float(106)
+        return self.get('Voltage')
 
     def get_temperature(self):
         """Return the sensor temperature in degC. 16 bit signet int, 1 Register"""
-        return self.read_register(108, signed = True)/10.0
+        return self.get('T')
 
     def get_led(self):
         """Return the led brightness. 16 bit unsignet int [0-100], 1 Register"""
-        return self.read_register(182)
+        return self.get('LED')
 
     def get_version(self):
         """Return the hardware version. 16 bit unsignet int [1-255], 1 Register"""
-        return self.read_register(1003)
+        return self.get('Version')
 
     def get_unit(self):
         """Return the measurement unit. char ['p' or 'g'], 1 Register
         
         This translates to p = ppm or g = mg/m3.
         """
-         
-        u = self.read_string(1005, number_of_registers = 1)
-        if u == 'g':
-            return 'mg/m3'
-        else: # other possibility is 'p'
-            return 'ppm'
-
-        # return self.read_string(1005, 1, number_of_registers = 1)
+        return self.get('Unit')
 
     def get_rf(self):
         """Return the response factor. 32 bit float [0.1 - 10.0], 2 Registers"""
-        return self.read_float(1010)
+        return self.get('RF')
 
     def get_range(self):
         """Return the sensor range. 16 bit unsignet int [10, 50, 1000, 3000], 1 Register"""
-        return self.read_register(1012)
+        return self.get('Range')
 
     def get_cal100(self):
         """Return the cal 100 value. 16 bit unsignet int [0 - 65535 (Default value 500) ], 1 Register"""
-        return self.read_register(1060)
+        return self.get('Cal100')
 
     def get_cal3000(self):
         """Return the cal 3000 value. 16 bit unsignet int [0 - 65535 (Default value 3000) ], 1 Register"""
-        return self.read_register(1061)
+        return self.get('Cal3000')
 
-    def readline(self):
-        """Return a list of dictionaries with current data.
+class AsyncFalco( AsyncRegisterMapDevice ):
+    """Falco driver for the asyncio transport (see aio.py).
 
-        dictionary keys are:
-            'var' -> variable name string
-            'val' -> value
-            'unit' -> unit string when applicable, otherwise '-'
-        """
-        response = [
-            {'var': 'VOC',
-            'val': round(self.get_voc(),2),
-            'unit': self.get_unit()},
-            {'var': 'Voltage',
-            'val': round(self.get_voltage(),1),
-            'unit': 'mV'},
-            {'var': 'T',
-            'val': self.get_temperature(),
-            'unit': 'degC'},
-            {'var': 'RF',
-            'val': self.get_rf(),
-            'unit': '-'},
-            {'var': 'Range',
-            'val': self.get_range(),
-            'unit': '-'}
-        ]
-
-        return response
+    Args:
+        * transport (aio.AsyncRTUTransport): transport of the bus
+        * slaveaddress (int): slave address in the range 1 to 247
+        * static_refresh (float): seconds between readings of the static registers
+        * periods (dict): var -> seconds between readings of slow variables
+
+    Use e.g. "data = await sensor.readline()" or "voc = await sensor.get('VOC')".
+    """
 
+    def __init__(self, transport, slaveaddress, static_refresh=600, periods=None):
+        AsyncRegisterMapDevice.__init__(self, transport, slaveaddress, 'falco',
+                                        static_refresh=static_refresh, periods=periods)
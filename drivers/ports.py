@@ -0,0 +1,132 @@
+import time
+import threading
+import serial
+import minimalmodbus
+
+from metrics import metrics
+from utils import log_message
+
+# Shared serial sessions.
+#
+# Without a shared session every minimalmodbus.Instrument opens and closes
+# the serial port for each register read (close_port_after_each_call). The
+# PortManager keeps one open handle per port, shares it between all the
+# instruments on that bus and serializes their transactions with a lock.
+
+class Port(object):
+    """One open serial port shared by several instruments.
+
+    Args:
+        * handle (serial.Serial): serial port object
+    """
+
+    def __init__(self, handle):
+        self.serial = handle
+        self.lock = threading.RLock()
+        self.settings = None
+
+        # statistics
+        self.transactions = 0
+        self.reopens = 0
+        self.busy_time = 0.0
+        self.open_cost = self.measure_open_cost()
+
+    def measure_open_cost(self):
+        """Return the time in seconds needed to close and reopen the port"""
+        with self.lock:
+            start = time.monotonic()
+            self.serial.close()
+            self.serial.open()
+            return time.monotonic() - start
+
+    def attach(self, instrument, settings):
+        """Let instrument use the shared serial handle.
+
+        The serial settings (dictionary of serial.Serial attributes) of the
+        first instrument are applied to the port. All the instruments on a
+        bus must use the same settings.
+        """
+        with self.lock:
+            if self.settings is None:
+                self.settings = settings
+                for key, value in settings.items():
+                    setattr(self.serial, key, value)
+            elif self.settings != settings:
+                log_message("LOGGER", "Serial settings {} of address {} differ from {} used on port {}".format(
+                    settings, instrument.address, self.settings, self.serial.port))
+            if instrument.serial is not self.serial:
+                instrument.serial.close()
+            instrument.serial = self.serial
+            instrument.close_port_after_each_call = False
+
+    def reopen(self):
+        """Close and reopen a stale handle"""
+        with self.lock:
+            try:
+                self.serial.close()
+            except (serial.SerialException, OSError):
+                pass
+            self.serial.open()
+            self.reopens += 1
+            metrics.count('serial.reopens')
+
+    def call(self, function, *args):
+        """Run function(*args) holding the port lock.
+
+        Closed handles are reopened before the call. If the call fails with
+        a serial error the handle is considered stale, reopened and the call
+        is repeated once. Modbus errors (timeouts, corrupt answers) are
+        passed to the caller, which decides about retries.
+        """
+        with self.lock:
+            start = time.monotonic()
+            try:
+                if not self.serial.is_open:
+                    self.reopen()
+                try:
+                    return function(*args)
+                except minimalmodbus.ModbusException:
+                    raise
+                except (serial.SerialException, OSError):
+                    self.reopen()
+                    metrics.count('modbus.retries')
+                    return function(*args)
+            finally:
+                self.transactions += 1
+                self.busy_time += time.monotonic() - start
+
+    def stats(self):
+        """Return a dictionary with the usage statistics of the port"""
+        with self.lock:
+            mean = self.busy_time/self.transactions if self.transactions else 0.0
+            return {'port': self.serial.port,
+                    'transactions': self.transactions,
+                    'reopens': self.reopens,
+                    'transaction_time': mean,
+                    'saved_per_transaction': self.open_cost,
+                    'saved_total': self.open_cost*self.transactions}
+
+class PortManager(object):
+    """Keeps one Port per port name"""
+
+    def __init__(self):
+        self.ports = {}
+        self.lock = threading.Lock()
+
+    def attach(self, instrument, settings):
+        """Share the port of instrument with the other instruments on that port"""
+        with self.lock:
+            name = instrument.serial.port
+            if name not in self.ports:
+                self.ports[name] = Port(instrument.serial)
+            port = self.ports[name]
+        port.attach(instrument, settings)
+        return port
+
+    def stats(self):
+        """Return the statistics of all managed ports"""
+        with self.lock:
+            return [port.stats() for port in self.ports.values()]
+
+# default manager used by the drivers
+port_manager = PortManager()
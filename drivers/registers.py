@@ -0,0 +1,480 @@
+import os
+import time
+import struct
+import json
+import minimalmodbus
+
+from ports import port_manager
+from timing import AdaptiveTimeout, RetryPolicy
+from metrics import metrics
+
+# directory holding the register map files (one json file per sensor type)
+maps_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'maps')
+
+# Maximum number of registers in a single read_registers call (modbus limit)
+MAX_BLOCK_LENGTH = 125
+
+# seconds a register group may be read before its period elapsed, so that
+# the jitter of the polls does not postpone it by a whole polling period
+PERIOD_TOLERANCE = 0.02
+
+# Helper functions for decoding blocks of modbus registers locally.
+#
+# A block read (minimalmodbus.Instrument.read_registers) returns a list of
+# 16 bit unsigned integers. The functions below reproduce the conversions
+# done by read_float(), read_register(signed=True) and read_string() so that
+# several values can be fetched in a single bus transaction.
+
+def decode_float(registers, index):
+    """Return the 32 bit float stored in registers[index:index+2] (big endian)"""
+    return struct.unpack('>f', struct.pack('>HH', registers[index], registers[index+1]))[0]
+
+def decode_signed(registers, index):
+    """Return the 16 bit signed int stored in registers[index]"""
+    value = registers[index]
+    if value >= 0x8000:
+        value -= 0x10000
+    return value
+
+def decode_string(registers, index, number_of_registers=1):
+    """Return the string stored in registers[index:index+number_of_registers]
+
+    Each register holds two characters, the first one in the high byte.
+    """
+    chars = struct.pack('>' + 'H'*number_of_registers,
+                        *registers[index:index+number_of_registers])
+    return chars.decode('latin-1')
+
+# number of registers used by each register type
+REGISTER_TYPES = {
+    'uint16': 1,
+    'int16': 1,
+    'float': 2,
+    'char': 1,
+    }
+
+class Register(object):
+    """One entry of a register map.
+
+    Keys of the json entry:
+        'var'       -> variable name string
+        'address'   -> first register address
+        'type'      -> 'uint16', 'int16', 'float', 'char' or 'string'
+        'length'    -> number of registers (only for 'string')
+        'scale'     -> (optional) factor applied to the raw value
+        'offset'    -> (optional) offset added after scaling
+        'round'     -> (optional) number of decimals kept
+        'unit'      -> (optional) unit string, otherwise '-'
+        'unit_from' -> (optional) name of a variable holding the unit
+        'map'       -> (optional) translation dictionary for 'char'/'string'
+        'default'   -> (optional) value used when 'map' has no match
+        'log'       -> (optional) false to exclude the variable from readline()
+        'static'    -> (optional) true for configuration values that are cached
+                       and only refreshed periodically (see RegisterMapInstrument)
+        'period'    -> (optional) seconds between readings of a slowly changing
+                       variable. Other readline() calls report the last value
+    """
+
+    def __init__(self, entry):
+        self.var       = entry['var']
+        self.address   = entry['address']
+        self.type      = entry.get('type', 'uint16')
+        if self.type == 'string':
+            self.count = entry['length']
+        elif self.type in REGISTER_TYPES:
+            self.count = REGISTER_TYPES[self.type]
+        else:
+            raise ValueError("Unknown register type '{}' for '{}'".format(self.type, self.var))
+        self.scale     = entry.get('scale')
+        self.offset    = entry.get('offset')
+        self.decimals  = entry.get('round')
+        self.unit      = entry.get('unit', '-')
+        self.unit_from = entry.get('unit_from')
+        self.map       = entry.get('map')
+        self.default   = entry.get('default')
+        self.log       = entry.get('log', True)
+        self.static    = entry.get('static', False)
+        self.period    = entry.get('period')
+
+    @property
+    def end(self):
+        """Address following the last register used by this entry"""
+        return self.address + self.count
+
+    def decode(self, registers, index):
+        """Return the value of this entry from a list of raw registers"""
+        if self.type == 'float':
+            value = decode_float(registers, index)
+        elif self.type == 'int16':
+            value = decode_signed(registers, index)
+        elif self.type in ('char', 'string'):
+            value = decode_string(registers, index, self.count).strip('\x00 ')
+            if self.map is not None:
+                value = self.map.get(value, self.default if self.default is not None else value)
+            return value
+        else:
+            value = registers[index]
+
+        if self.scale is not None:
+            value = value*self.scale
+        if self.offset is not None:
+            value = value + self.offset
+        if self.decimals is not None:
+            value = round(value, self.decimals)
+
+        return value
+
+class Block(object):
+    """Contiguous range of registers fetched with one read_registers call"""
+
+    def __init__(self, register):
+        self.start = register.address
+        self.end = register.end
+        self.registers = [register]
+
+    @property
+    def count(self):
+        return self.end - self.start
+
+    def add(self, register):
+        self.registers.append(register)
+        self.end = max(self.end, register.end)
+
+    def decode(self, raw):
+        """Return a dictionary var -> value from the raw block registers"""
+        return {r.var: r.decode(raw, r.address - self.start) for r in self.registers}
+
+class RegisterGroup(object):
+    """Registers read together at their own period.
+
+    Args:
+        * period (float): seconds between readings, 0 for every readline()
+        * blocks (list): Blocks of the registers
+
+    values holds the result of the last reading.
+    """
+
+    def __init__(self, period, blocks):
+        self.period = period
+        self.blocks = blocks
+        self.next = None        # time.monotonic() of the next reading
+        self.values = {}
+
+    def due(self, now):
+        return not self.period or self.next is None or now >= self.next - PERIOD_TOLERANCE
+
+    def store(self, values, now):
+        """Keep the values read at now and schedule the next reading"""
+        self.values = values
+        if self.next is None or self.next + self.period <= now:
+            self.next = now + self.period
+        else:
+            self.next += self.period    # keep the cadence
+
+    def invalidate(self):
+        self.next = None
+
+class RegisterCache(object):
+    """Last readings of the register groups of a driver.
+
+    Args:
+        * register_map (RegisterMap): map of the device
+        * static_refresh (float): seconds between readings of the static registers
+        * periods (dict): var -> seconds, see RegisterMap.groups()
+
+    Shared by RegisterMapInstrument and aio.AsyncRegisterMapDevice, which
+    only do the bus reads: due() returns the groups to read, the driver
+    passes the values it read to store() and reports values().
+    """
+
+    def __init__(self, register_map, static_refresh=600, periods=None):
+        self.static = RegisterGroup(static_refresh, register_map.plan(register_map.static()))
+        self.groups = [self.static] + register_map.groups(periods)
+
+    def due(self, static_only=False):
+        """Return the groups whose period elapsed (only the static one with static_only)"""
+        now = time.monotonic()
+        groups = [self.static] if static_only else self.groups
+        return [group for group in groups if group.due(now)]
+
+    def store(self, group, values):
+        group.store(values, time.monotonic())
+
+    def values(self):
+        """Return a dictionary var -> last reading of all the groups"""
+        values = {}
+        for group in self.groups:
+            values.update(group.values)
+        return values
+
+    def invalidate(self):
+        """Read all the groups on the next access"""
+        for group in self.groups:
+            group.invalidate()
+
+def plan_blocks(registers, max_gap=0, max_length=MAX_BLOCK_LENGTH):
+    """Return the list of Blocks covering registers with the fewest reads.
+
+    Registers are merged into one block when the number of unused registers
+    between them is at most max_gap and the block stays below max_length.
+    Scanning the registers sorted by address and extending the current block
+    as far as allowed gives the minimum number of blocks.
+    """
+    blocks = []
+    for register in sorted(registers, key=lambda r: r.address):
+        if (blocks and register.address - blocks[-1].end <= max_gap
+                and max(blocks[-1].end, register.end) - blocks[-1].start <= max_length):
+            blocks[-1].add(register)
+        else:
+            blocks.append(Block(register))
+
+    return blocks
+
+class RegisterMap(object):
+    """Register map of a sensor loaded from a json file.
+
+    Json keys:
+        'name'      -> sensor name
+        'serial'    -> serial settings (baudrate, bytesize, parity, stopbits, timeout)
+        'max_gap'   -> (optional) unused registers allowed inside a block read
+        'registers' -> list of register entries (see Register)
+    """
+
+    def __init__(self, data):
+        self.name      = data.get('name', '')
+        self.serial    = data.get('serial', {})
+        self.max_gap   = data.get('max_gap', 0)
+        self.registers = [Register(entry) for entry in data['registers']]
+        self.vars      = {r.var: r for r in self.registers}
+
+    @classmethod
+    def load(cls, name):
+        """Load a map from a file path or by name from the maps directory"""
+        path = name
+        if not os.path.exists(path):
+            path = os.path.join(maps_path, name + '.json')
+        with open(path, "r") as jsonfile:
+            return cls(json.load(jsonfile))
+
+    def logged(self):
+        """Return the register entries reported by readline()"""
+        return [r for r in self.registers if r.log]
+
+    def live(self):
+        """Return the non static entries needed by readline()"""
+        return [r for r in self.required(self.logged()) if not r.static]
+
+    def static(self):
+        """Return all static entries"""
+        return [r for r in self.registers if r.static]
+
+    def required(self, registers):
+        """Return registers plus the entries they take their unit from"""
+        required = list(registers)
+        for r in registers:
+            if r.unit_from and self.vars[r.unit_from] not in required:
+                required.append(self.vars[r.unit_from])
+        return required
+
+    def plan(self, registers):
+        return plan_blocks(registers, self.max_gap)
+
+    def groups(self, periods=None):
+        """Return the RegisterGroups of the live registers, fastest first.
+
+        periods (dict var -> seconds) overrides the 'period' of the map
+        entries. Variables without period are read on every readline().
+        """
+        periods = dict(periods or {})
+        live_vars = [r.var for r in self.live()]
+        for var in periods:
+            if var not in self.vars:
+                raise ValueError("Unknown variable '{}' in periods of '{}'".format(var, self.name))
+            if var not in live_vars:
+                raise ValueError("'{}' of '{}' is static or not logged and has no period".format(
+                    var, self.name))
+        live = {}
+        for r in self.live():
+            live.setdefault(periods.get(r.var, r.period) or 0, []).append(r)
+        return [RegisterGroup(period, self.plan(registers))
+                for period, registers in sorted(live.items())]
+
+    def response(self, values):
+        """Return the readline() list of dictionaries from var -> value"""
+        response = []
+        for r in self.logged():
+            if r.unit_from:
+                unit = values[r.unit_from]
+            else:
+                unit = r.unit
+            response.append({'var': r.var, 'val': values[r.var], 'unit': unit})
+
+        return response
+
+def error_counter(error):
+    """Return the name of the metrics counter of a minimalmodbus exception"""
+    if isinstance(error, minimalmodbus.NoResponseError):
+        return 'modbus.timeouts'
+    if isinstance(error, minimalmodbus.SlaveReportedException):
+        return 'modbus.exceptions'
+    if 'Checksum' in str(error):
+        return 'modbus.crc_errors'
+    return 'modbus.invalid_responses'
+
+class RegisterMapInstrument( minimalmodbus.Instrument ):
+    """Generic instrument class driven by a register map.
+
+    Args:
+        * portname (str): port name
+        * slaveaddress (int): slave address in the range 1 to 247
+        * register_map (str or RegisterMap): map name in drivers/maps, path
+          to a json map file or a RegisterMap object
+        * static_refresh (float): seconds after which the cached static
+          registers are read again
+        * shared_port (bool): keep the serial port open and share it with
+          the other instruments on the same port (see ports.py)
+        * retries (int): repetitions of a transaction after a timeout or a
+          corrupt answer
+        * adaptive_timeout (bool): derive the response timeout from the
+          serial settings and the observed latency (see timing.py). The
+          timeout of the register map is the upper limit
+        * periods (dict): var -> seconds between readings, overrides the
+          'period' of the register map entries
+
+    Static registers (configuration values such as units or calibration
+    factors) are read on the first call to readline() and afterwards only
+    every static_refresh seconds or after invalidate() was called. All
+    other calls to readline() only read the live measurement registers,
+    and of these only the ones whose period elapsed (see RegisterGroup).
+    The other variables report their last reading.
+
+    """
+
+    def __init__(self, portname, slaveaddress, register_map, static_refresh=600,
+                 shared_port=True, retries=2, adaptive_timeout=True, periods=None):
+        minimalmodbus.Instrument.__init__(self, portname, slaveaddress,
+                                          mode=minimalmodbus.MODE_RTU)
+
+        if not isinstance(register_map, RegisterMap):
+            register_map = RegisterMap.load(register_map)
+        self.register_map = register_map
+
+        #Make the settings explicit
+        settings = self.register_map.serial
+        self.settings = {
+            'baudrate': settings.get('baudrate', 9600),     # Baud
+            'bytesize': settings.get('bytesize', 8),
+            'parity':   settings.get('parity', minimalmodbus.serial.PARITY_NONE),
+            'stopbits': settings.get('stopbits', 1),
+            'timeout':  settings.get('timeout', 1),         # seconds
+            }
+
+        # Good practice
+        self.clear_buffers_before_each_transaction = True
+        if shared_port:
+            self.port = port_manager.attach(self, self.settings)
+        else:
+            self.port = None
+            self.close_port_after_each_call = True
+            for key, value in self.settings.items():
+                setattr(self.serial, key, value)
+
+        # timeouts and retries of the transactions
+        self.retry = RetryPolicy(retries)
+        self.attempt = 0
+        self.probing = False    # set by bus.Device while the device is failing: no retries
+        if adaptive_timeout:
+            self.timing = AdaptiveTimeout(self.settings['baudrate'], self.settings['bytesize'],
+                                          self.settings['parity'], self.settings['stopbits'],
+                                          max_timeout=self.settings['timeout'])
+        else:
+            self.timing = None
+
+        # block reads used by readline(), grouped by reading period, and
+        # the last values of each group
+        self.cache = RegisterCache(self.register_map, static_refresh, periods)
+
+    def _perform_command(self, functioncode, payload_to_slave):
+        # Every request/response passes here. Timeouts, corrupt answers and
+        # busy slaves are retried after a short random pause. Durations and
+        # failures are recorded (see metrics.py)
+        retries = 0 if self.probing else self.retry.retries
+        for attempt in range(retries + 1):
+            self.attempt = attempt
+            try:
+                with metrics.timer('modbus.transaction'):
+                    return minimalmodbus.Instrument._perform_command(self, functioncode,
+                                                                     payload_to_slave)
+            except (minimalmodbus.NoResponseError, minimalmodbus.InvalidResponseError,
+                    minimalmodbus.SlaveDeviceBusyError) as e:
+                metrics.count(error_counter(e))
+                if attempt == retries:
+                    raise
+            except minimalmodbus.ModbusException as e:
+                metrics.count(error_counter(e))
+                raise
+            metrics.count('modbus.retries')
+            time.sleep(self.retry.delay(attempt))
+
+    def _communicate(self, request, number_of_bytes_to_read):
+        # Every modbus transaction passes here. Serialize the transactions
+        # on shared ports and reopen stale handles.
+        if self.port is None:
+            return self._exchange(request, number_of_bytes_to_read)
+        return self.port.call(self._exchange, request, number_of_bytes_to_read)
+
+    def _exchange(self, request, number_of_bytes_to_read):
+        # One request/response (with the port lock held on shared ports)
+        if self.timing is None:
+            timeout = self.settings['timeout']
+        else:
+            timeout = self.timing.timeout(len(request), number_of_bytes_to_read, self.attempt)
+        if self.serial.timeout != timeout:
+            self.serial.timeout = timeout
+
+        start = time.perf_counter()
+        try:
+            response = minimalmodbus.Instrument._communicate(self, request,
+                                                             number_of_bytes_to_read)
+        except minimalmodbus.NoResponseError:
+            if self.timing is not None:
+                self.timing.expired()
+            raise
+        if self.timing is not None and len(response) == number_of_bytes_to_read:
+            self.timing.observe(time.perf_counter() - start, len(request),
+                                number_of_bytes_to_read)
+        return response
+
+    def read_blocks(self, blocks):
+        """Return a dictionary var -> value reading each block once"""
+        values = {}
+        for block in blocks:
+            values.update(block.decode(self.read_registers(block.start, block.count)))
+        return values
+
+    def invalidate(self):
+        """Force a new reading of the static and slow registers on the next access"""
+        self.cache.invalidate()
+
+    def update(self, static_only=False):
+        """Read the register groups whose period elapsed and return all the values"""
+        for group in self.cache.due(static_only):
+            self.cache.store(group, self.read_blocks(group.blocks))
+        return self.cache.values()
+
+    def get(self, var):
+        """Return the current value of a single variable"""
+        register = self.register_map.vars[var]
+        if register.static:
+            return self.update(static_only=True)[var]
+        return self.read_blocks(plan_blocks([register]))[var]
+
+    def readline(self):
+        """Return a list of dictionaries with current data.
+
+        dictionary keys are:
+            'var' -> variable name string
+            'val' -> value
+            'unit' -> unit string when applicable, otherwise '-'
+        """
+        return self.register_map.response(self.update())
@@ -1,72 +1,53 @@
-import minimalmodbus
+from registers import RegisterMapInstrument
+from aio import AsyncRegisterMapDevice
 
-class SMT100( minimalmodbus.Instrument ):
-    """Instrument class for ION Falco VOC Measurement Device.
+class SMT100( RegisterMapInstrument ):
+    """Instrument class for Truebner SMT100 soil moisture sensor.
+
+    The registers are described in maps/smt100.json.
 
     Args:
         * portname (str): port name
         * slaveaddress (int): slave address in the range 1 to 247
+        * static_refresh (float): seconds between readings of the static registers
+        * periods (dict): var -> seconds between readings of slow variables
 
     """
 
-    def __init__(self, portname, slaveaddress):
-        minimalmodbus.Instrument.__init__(self, portname, slaveaddress, mode=minimalmodbus.MODE_RTU)
-        
-        #Make the settings explicit
-        self.serial.baudrate = 9600        # Baud
-        self.serial.bytesize = 8
-        self.serial.parity   = minimalmodbus.serial.PARITY_EVEN
-        self.serial.stopbits = 1
-        self.serial.timeout  = 1          # seconds
-
-        # Good practice
-        self.close_port_after_each_call = True
-        self.clear_buffers_before_each_transaction = True
+    def __init__(self, portname, slaveaddress, static_refresh=600, periods=None):
+        RegisterMapInstrument.__init__(self, portname, slaveaddress, 'smt100',
+                                       static_refresh=static_refresh, periods=periods)
         
         print("SMT initialized in port {}:{}".format(portname, slaveaddress))
 
     def get_temp(self):
         """Return the soil temperature in degC. 16 bit unsignet int, 1 Register"""
-        temperature = self.read_register(0)/100.0 - 100.0
-
-        return round(temperature,1)
+        return self.get('T')
 
     def get_moist(self):
         """Return the soil moisture reading in vol%. 16 bit unsignet int, 1 Register"""
-        response = self.read_register(1)/100.0
-
-        return round(response,1)
+        return self.get('Moist')
 
     def get_perm(self):
         """Return the soil permittivity reading in arb. units. 16 bit unsignet int, 1 Register"""
-        return self.read_register(2)
+        return self.get('Perm')
 
     def get_count(self):
         """Return the led brightness in arb. units. 16 bit unsignet int, 1 Register"""
-    
-        return self.read_register(3)
+        return self.get('Count')
 
-    def readline(self):
-        """Return a list of dictionaries with current data.
+class AsyncSMT100( AsyncRegisterMapDevice ):
+    """SMT100 driver for the asyncio transport (see aio.py).
 
-        dictionary keys are:
-            'var' -> variable name string
-            'val' -> value
-            'unit' -> unit string when applicable, otherwise '-'
-        """
-        response = [
-            {'var': 'T',
-            'val': self.get_temp(),
-            'unit': 'degC'},
-            {'var': 'Moist',
-            'val': self.get_moist(),
-            'unit': 'vol%'},
-#             {'var': 'Perm',
-#             'val': self.get_perm(),
-#             'unit': '-'},
-            {'var': 'Count',
-            'val': self.get_count(),
-            'unit': '#'}
-        ]
+    Args:
+        * transport (aio.AsyncRTUTransport): transport of the bus
+        * slaveaddress (int): slave address in the range 1 to 247
+        * static_refresh (float): seconds between readings of the static registers
+        * periods (dict): var -> seconds between readings of slow variables
+
+    Use e.g. "data = await sensor.readline()" or "moist = await sensor.get('Moist')".
+    """
 
-        return response
+    def __init__(self, transport, slaveaddress, static_refresh=600, periods=None):
+        AsyncRegisterMapDevice.__init__(self, transport, slaveaddress, 'smt100',
+                                        static_refresh=static_refresh, periods=periods)
@@ -0,0 +1,98 @@
+import random
+
+# Response timeouts and retries of Modbus transactions.
+#
+# A fixed serial timeout of one second means that every lost answer costs
+# a second of bus time. AdaptiveTimeout waits only as long as the frames
+# need on the wire plus the turnaround time observed for the slave, and
+# RetryPolicy repeats failed transactions a few times after a short random
+# pause, so a disturbed frame costs milliseconds instead of a sample.
+
+class AdaptiveTimeout(object):
+    """Response timeout of one slave.
+
+    Args:
+        * baudrate, bytesize, parity, stopbits: serial settings of the bus
+        * max_timeout (float): upper limit (the configured serial timeout)
+        * min_timeout (float): lower limit in seconds
+        * margin (float): seconds added for the scheduling of the host
+
+    The turnaround time of the slave (roundtrip minus transmission time of
+    request and response) is smoothed like the round trip time of TCP:
+    timeout = transmission + mean + 4*deviation + margin. Every retry of the
+    same transaction doubles the timeout.
+
+    Until enough transactions were observed the turnaround is guessed,
+    starting with DEFAULT_TURNAROUND. Every timeout doubles the guess up to
+    max_timeout and then starts again, so a slave that does not answer
+    costs little bus time and a slow one is still found.
+    """
+
+    MIN_SAMPLES = 5     # transactions observed before the timeout is adapted
+    DEFAULT_TURNAROUND = 0.1
+
+    def __init__(self, baudrate=9600, bytesize=8, parity='N', stopbits=1, max_timeout=1.0,
+                 min_timeout=0.01, margin=0.005):
+        # start bit + data bits + parity bit + stop bits
+        self.char_time = (1 + bytesize + (parity != 'N') + stopbits)/float(baudrate)
+        self.max_timeout = max_timeout
+        self.min_timeout = min_timeout
+        self.margin = margin
+        self.samples = 0
+        self.mean = 0.0
+        self.deviation = 0.0
+        self.guess = self.DEFAULT_TURNAROUND
+
+    def transmission(self, request_bytes, response_bytes):
+        """Return the seconds needed to send the request and the response"""
+        return (request_bytes + response_bytes)*self.char_time
+
+    def timeout(self, request_bytes, response_bytes, attempt=0):
+        """Return the timeout for a transaction (attempt counts the retries)"""
+        transmission = self.transmission(request_bytes, response_bytes)
+        if self.samples < self.MIN_SAMPLES:
+            # the guess already grows with every timeout
+            timeout = transmission + max(self.guess, 2*self.mean) + self.margin
+        else:
+            timeout = (transmission + self.mean + 4*self.deviation + self.margin)*2**attempt
+        return min(max(timeout, self.min_timeout), self.max_timeout)
+
+    def observe(self, roundtrip, request_bytes, response_bytes):
+        """Add the roundtrip time in seconds of a successful transaction"""
+        turnaround = max(roundtrip - self.transmission(request_bytes, response_bytes), 0.0)
+        if not self.samples:
+            self.mean = turnaround
+            self.deviation = turnaround/2
+        else:
+            self.deviation = 0.75*self.deviation + 0.25*abs(self.mean - turnaround)
+            self.mean = 0.875*self.mean + 0.125*turnaround
+        self.samples += 1
+
+    def expired(self):
+        """Note a transaction without answer"""
+        if self.samples < self.MIN_SAMPLES:
+            if self.guess >= self.max_timeout:
+                self.guess = self.DEFAULT_TURNAROUND
+            else:
+                self.guess = min(2*self.guess, self.max_timeout)
+
+class RetryPolicy(object):
+    """Bounded retries with jittered exponential backoff.
+
+    Args:
+        * retries (int): repetitions of a failed transaction
+        * backoff (float): upper limit in seconds of the first pause
+        * max_backoff (float): upper limit of all pauses
+
+    The pause before retry n is random between 0 and backoff*2**n, so
+    several masters or devices do not retry in lockstep.
+    """
+
+    def __init__(self, retries=2, backoff=0.005, max_backoff=0.1):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt):
+        """Return the pause in seconds after the failed attempt (0 for the first)"""
+        return random.uniform(0, min(self.max_backoff, self.backoff*2**attempt))
@@ -8,23 +8,75 @@ import pyqtgraph as pg
 import socket
 import sys, os
 import numpy as np
-import pandas as pd
 import datetime, time
 import json
 import configparser
+import signal
 
-from utils import TimeAxisItem, timestamp, log_message
+from utils import TimeAxisItem, log_message, log_exception
+from protocol import Decoder
+from buffers import RingBuffer, MinMaxPyramid, forward_fill
+from storage import load_history
+from bus import device_name
 
 # path where the config.ini file is located
 base_path = os.path.abspath(os.path.dirname(sys.argv[0]))
 
+class Receiver(QtCore.QThread):
+    """Receives the data frames from the broker outside of the Qt event loop.
+
+    Every recv() chunk is decoded and its complete messages are emitted at
+    once as a list of (timestamp, data) tuples with the received signal.
+    The thread reconnects by itself when the broker is not available.
+    """
+
+    received = QtCore.pyqtSignal(list)
+
+    def __init__(self, server_address):
+        QtCore.QThread.__init__(self)
+        self.server_address = server_address
+
+    def run(self):
+        while not self.isInterruptionRequested():
+            # connect to the broker as a subscriber (retry until it is available)
+            try:
+                connection = socket.create_connection(self.server_address, timeout=1)
+            except socket.error:
+                self.msleep(1000)
+                continue
+            log_message("GUI",'connected to {}'.format(self.server_address))
+            decoder = Decoder()
+
+            try:
+                while not self.isInterruptionRequested():
+                    try:
+                        chunk = connection.recv(65536)
+                    except socket.timeout:
+                        continue
+                    if not chunk:
+                        log_message("GUI", "Nothing received!")
+                        log_message("GUI", "Trying to reconnect.")
+                        break
+
+                    # decode the frames into (timestamp, data) messages
+                    messages = decoder.feed(chunk)
+                    if messages:
+                        self.received.emit(messages)
+            except socket.error:
+                log_message("GUI", "Connection lost! Trying to reconnect.")
+            finally:
+                connection.close()
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
+
 class Visualizer(object):
-    def __init__(self, host_name='localhost', host_port=10000, json_config=False):
+    def __init__(self, host_name='localhost', host_port=10001, json_config=False):
         
-        # init socket
+        # socket information
         self.host_name = host_name
         self.host_port = host_port
-        self.initSocket()
 
         # init pyqt
         self.app = QtWidgets.QApplication([])
@@ -35,7 +87,11 @@ class Visualizer(object):
 
         #init data structure
         self.firstLoop = True 
-        self.datastring = ""
+        self.dirty = False      # new data since the last redraw
+        self.stale = set()      # tabs whose plots were not redrawn since new data
+        self.pending = []       # received messages waiting for the next frame
+        self.newData = {}       # last received values (for the info text)
+        self.recvUnit = {}
         self.timeKey = 'Date/Time'
 
         # variables to keep for front end
@@ -52,6 +108,7 @@ class Visualizer(object):
         self.plotVariable = json_data['plots']
         self.tabLabel = json_data['tabslabels']
         self.infoText = json_data['infotext']
+        self.fps = json_data.get('fps', 10)   # maximum redraws per second
             
         # pen styles
         self.pen = [
@@ -61,8 +118,10 @@ class Visualizer(object):
             pg.mkPen('r', width=1, style=QtCore.Qt.DashLine)
         ] 
         
-        # dataframe that will hold the data
-        self.df = pd.DataFrame(columns=self.keys)
+        # preallocated ring buffer that will hold the data
+        self.buffer = RingBuffer(self.numSamples, self.keys)
+        # min/max levels used to draw long histories
+        self.pyramid = MinMaxPyramid(self.buffer, self.timeKey)
 
         # setup plots
         self.curve = {}
@@ -79,6 +138,8 @@ class Visualizer(object):
                 self.plot[t][p].addLegend()
                 self.plot[t][p].setLabel('bottom', "Time")
                 self.plot[t][p].showGrid(False, True)
+                # zooming or panning requires other points
+                self.plot[t][p].getViewBox().sigRangeChangedManually.connect(self.rangeChanged)
                 
         for index in range(len(self.plotVariable)):
             p = self.plotVariable[index]['plot']
@@ -88,7 +149,12 @@ class Visualizer(object):
                 lbl = self.plotVariable[index]['var']
             self.curve[index] = self.plot[t][p].plot([], [],
                                         pen=self.pen[self.plotVariable[index]['pen']],
-                                        name=lbl)
+                                        name=lbl, connect='finite')
+
+        # curves shown on each tab
+        self.tabCurves = [[] for t in range(lastTab['tab'] + 1)]
+        for index in range(len(self.plotVariable)):
+            self.tabCurves[self.plotVariable[index]['tab']].append(index)
 
 #####################################################################
 
@@ -116,6 +182,8 @@ class Visualizer(object):
                 lbl = "Tab &{}".format(index+1)
             self.tabWidget.addTab(self.tabContentWidget[index], lbl)
             self.tabContentWidget[index].setLayout(self.tabLayout[index])
+        # hidden tabs are only redrawn when they are shown again
+        self.tabWidget.currentChanged.connect(self.update)
 
         ## add the plots
         for index in range(len(self.plotVariable)):
@@ -138,109 +206,156 @@ class Visualizer(object):
         self.widgets.setLayout(self.centralLayout)
         self.widgets.show()
 
-    def update(self):
-
-        try:
-            # wait for new data to arrive
-            self.datastring = self.connection.recv(1024).decode()
-            if not self.datastring:
-                log_message("GUI", "Nothing received!")
-                log_message("GUI", "Trying to reconnect.")
-                self.connection, self.client_address = self.sock.accept() # Wait for a connection
-                log_message("GUI",'connection from {}'.format(self.client_address))
-
-
-            # if more than one datapoint was received keep only the first one.
-            # Only affects the GUI. All points are saved by logger.py 
-            two_points = self.datastring.find('][')
-            if two_points > 0:
-                    self.datastring = self.datastring[0:two_points+1]
-
-            # decode json string into a value and a units dictionaries
+        ## receive data in the background and redraw at a capped frame rate
+        self.initSocket()
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.update)
+        self.timer.start(int(1000/self.fps))
+
+    def receive(self, messages):
+        # called in the Qt thread with the messages of one recv() chunk.
+        # The messages are only queued, update() processes them once per frame
+        self.pending.extend(messages)
+
+    def drain(self):
+        # decode all the pending messages and append them to the data buffer
+        # in one step. Variables missing in a message (e.g. sent by another
+        # device) keep their last value, so that only the gaps sent by the
+        # logger (NaN) break the curves
+        messages = self.pending
+        self.pending = []
+
+        rows = []
+        for sampleTime, dataDict in messages:
             recvData = {}
-            recvUnit = {}
-            if self.datastring:
-                dataDict = json.loads(self.datastring)
-                for v in dataDict:
-                        recvData[v['var']] = v['val']
-                        recvUnit[v['var']] = v['unit']
+            for v in dataDict:
+                recvData[v['var']] = v['val']
+                self.recvUnit[v['var']] = v['unit']
 
             # reduce the data to the subset required by the GUI
-            # then update the dataframe and the front end
-            if recvData:
-                newData = {}
- 
-                for k in self.keys:
-                    if k != self.timeKey:
-                        try:
-                           newData[k] = recvData[k]
-                        except:
-                           log_message("GUI","could not extract {} value from {}".format(k, dataDict))
-                    else:
-                        # add the time as variable using the local time
-                        newData[k] = timestamp()
-
-                # reshape dataframe to a maximum of self.numSamples points
-                dfRowCount = len(self.df.index)
-                if dfRowCount >= self.numSamples:
-                    self.df = self.df.tail(self.numSamples-1)
-                    self.df = pd.concat([self.df, pd.DataFrame([newData])],ignore_index=True)
-                elif dfRowCount == 0:
-                    self.df = pd.DataFrame.from_dict([newData])
-                else:
-                    self.df = pd.concat([self.df, pd.DataFrame([newData])],ignore_index=True)
-
-                # update the plots
+            newData = {k: recvData[k] for k in self.keys if k in recvData}
+            if newData:
+                # add the time as variable using the acquisition time
+                newData[self.timeKey] = sampleTime
+                self.newData.update(newData)
+                rows.append(dict(self.newData))
+
+        if rows:
+            # the buffer keeps the last self.numSamples points
+            self.buffer.extend({k: [row.get(k, np.nan) for row in rows] for k in self.keys})
+            self.pyramid.update()
+            self.stale.update(range(len(self.tabCurves)))
+            self.dirty = True
+
+    def backfill(self, path, sources, extension):
+        # fill the buffer with the last datapoints from the datafiles written
+        # by logger.py. sources is a list of (device name, variable prefix)
+        blocks = []
+        for name, prefix in sources:
+            columns, units = load_history(path, name, extension, self.numSamples)
+            if not len(columns.get('time', [])):
+                continue
+            block = {self.timeKey: columns['time']}
+            for var, values in columns.items():
+                key = prefix + var
+                if key not in self.keys or key == self.timeKey:
+                    continue
+                self.recvUnit[key] = units[var]
+                self.newData[key] = values[-1]
+                try:
+                    block[key] = np.asarray(values, dtype=float)
+                except ValueError:
+                    pass    # text values can not be plotted
+            blocks.append(block)
+
+        if not blocks:
+            return
+        # merge the devices in time order and keep the last self.numSamples
+        # points. Like in drain(), the rows of one device carry the last
+        # values of the other devices
+        times = np.concatenate([block[self.timeKey] for block in blocks])
+        order = np.argsort(times, kind='stable')
+        history = {}
+        for k in self.keys:
+            values = np.concatenate([block.get(k, np.full(len(block[self.timeKey]), np.nan))
+                                     for block in blocks])[order]
+            present = np.concatenate([np.full(len(block[self.timeKey]), k in block)
+                                      for block in blocks])[order]
+            history[k] = forward_fill(values, present)[-self.numSamples:]
+        order = order[-self.numSamples:]
+        self.buffer.extend(history)
+        self.pyramid.update()
+        self.stale.update(range(len(self.tabCurves)))
+        self.dirty = True
+        log_message("GUI", "Loaded {} datapoints from {}".format(len(order), path))
+
+    def rangeChanged(self, *args):
+        # only the plots of the visible tab can be zoomed
+        self.stale.add(self.tabWidget.currentIndex())
+
+    def curveData(self, index):
+        # return the points of a curve matching the visible range and plot width
+        p = self.plotVariable[index]['plot']
+        t = self.plotVariable[index]['tab']
+        viewBox = self.plot[t][p].getViewBox()
+        x0 = x1 = None
+        if not viewBox.autoRangeEnabled()[0]:
+            x0, x1 = viewBox.viewRange()[0]
+        return self.pyramid.select(self.plotVariable[index]['var'], x0, x1,
+                                   int(viewBox.width()) or None)
+
+    def update(self):
+        # redraws the front end (called by the timer at most fps times per second
+        # and when another tab is selected)
+        try:
+            if self.pending:
+                self.drain()
+
+            # update the plots of the visible tab
+            tab = self.tabWidget.currentIndex()
+            if tab in self.stale:
+                self.stale.discard(tab)
+                for index in self.tabCurves[tab]:
+                    self.curve[index].setData(*self.curveData(index))
+
+            if not self.dirty:
+                return
+
+            # modify y-axis to show variable name and units
+            if self.firstLoop:
                 for index in range(len(self.plotVariable)):
-                    self.curve[index].setData(self.df[self.timeKey], self.df[self.plotVariable[index]['var']])
-
-                # modify y-axis to show variable name and units
-                if self.firstLoop:
-                    for index in range(len(self.plotVariable)):
-                        p = self.plotVariable[index]['plot']
-                        t = self.plotVariable[index]['tab']
-                        self.plot[t][p].setLabel('left',
-                            self.plotVariable[index]['var'],
-                            units=recvUnit[self.plotVariable[index]['var']])
-                        
-                    self.firstLoop = False
-
-                # format the text field(s)
-                infoData = []
-                for v in self.infoText['variables']:
-                    infoData.append(newData[v])
-                self.lblTextData.setText(
-                    self.infoText['text'].format(*infoData))
-
-        except KeyboardInterrupt:
-            log_message("GUI", "aborted by user!")
-            self.sock.close()
-            exit()
+                    p = self.plotVariable[index]['plot']
+                    t = self.plotVariable[index]['tab']
+                    self.plot[t][p].setLabel('left',
+                        self.plotVariable[index]['var'],
+                        units=self.recvUnit[self.plotVariable[index]['var']])
+                    
+                self.firstLoop = False
+
+            # format the text field(s)
+            infoData = []
+            for v in self.infoText['variables']:
+                infoData.append(self.newData[v])
+            self.lblTextData.setText(
+                self.infoText['text'].format(*infoData))
+            self.dirty = False
 
         except:
-            log_message("GUI", "    --- error type: " + str(sys.exc_info()[0]))
-            log_message("GUI", "    --- error value: " + str(sys.exc_info()[1]))
-            exec_tb = sys.exc_info()[2]
-            fname = os.path.split(exec_tb.tb_frame.f_code.co_filename)[1]
-            log_message("GUI", "    --- error File: {}".format(fname))
-            log_message("GUI", "    --- error line: {}".format(exec_tb.tb_lineno))
-            
-##            raise
+            log_exception("GUI", "could not update the plots")
+            self.dirty = False
+
     def initSocket(self):
-        # init socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # Create a TCP/IP socket
+        # start the thread receiving the data from the broker
         self.server_address = (self.host_name, self.host_port)
-        log_message("GUI",'starting up on {}'.format(self.server_address))
-        self.sock.bind(self.server_address) # Bind the socket to the port
-        self.sock.listen(1) # Listen for incoming connections
-        log_message("GUI",'waiting for a connection')
-        self.connection, self.client_address = self.sock.accept() # Wait for a connection
-        log_message("GUI",'connection from {}'.format(self.client_address))
+        log_message("GUI",'subscribing to {}'.format(self.server_address))
+        self.receiver = Receiver(self.server_address)
+        self.receiver.received.connect(self.receive)
+        self.receiver.start()
 
     def closeSocket(self):
         log_message("GUI", "Window is clossing!")
         log_message("GUI", "Closing the active socket")
-        self.sock.close()
+        self.receiver.stop()
         log_message("GUI", "bye...")
 
 ## Start Qt event loop unless running in interactive mode or using pyside.
@@ -253,8 +368,18 @@ if __name__ == '__main__':
         config = configparser.ConfigParser()
         config.read(config_file)
         host_name = eval(config['TCP_INTERFACE']['HOST_NAME'])
-        host_port = eval(config['TCP_INTERFACE']['HOST_PORT'])
+        host_port = eval(config['TCP_INTERFACE'].get('SUBSCRIBE_PORT', '10001'))
         json_config = eval(config['GUI']['JSON_CONFIG'])
+        history = eval(config['GUI'].get('HISTORY', 'True'))
+
+        # datafiles of the devices written by logger.py
+        data_path = eval(config['GENERAL_SETTINGS']['DATA_PATH']) + '/'
+        extension = eval(config['LOGGER']['EXTENSION'])
+        devices_config = eval(config['GENERAL_SETTINGS'].get('DEVICES', '[]'))
+        if devices_config:
+            sources = [(device_name(entry), entry.get('prefix', '')) for entry in devices_config]
+        else:
+            sources = [(eval(config['LOGGER']['DATAFILE']), '')]
     else:
         log_message("GUI","Could not find the configuration file: {}".format(config_file))
         exit()
@@ -262,9 +387,18 @@ if __name__ == '__main__':
 
     vis = Visualizer(host_name=host_name, host_port=host_port, json_config=json_config)
 
-    timer = QtCore.QTimer()
-    timer.timeout.connect(vis.update)
-    timer.start()
+    # show the recent history before the live data arrives
+    if history:
+        try:
+            vis.backfill(data_path, sources, extension)
+        except:
+            log_exception("GUI", "could not load the history from {}".format(data_path))
+
+    # close the window cleanly on Ctrl+C (checked every time the timer runs)
+    def abort(signum, frame):
+        log_message("GUI", "aborted by user!")
+        vis.app.quit()
+    signal.signal(signal.SIGINT, abort)
 
     if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
         QtWidgets.QApplication.instance().exec_()
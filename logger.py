@@ -1,37 +1,121 @@
 #!/usr/bin/env python
 
 import os, sys
-import datetime, time
+import time
 import configparser
-import json
+import queue
+import asyncio
 import minimalmodbus
-import socket
 
 ## Import function for sending data to gui.py
-from utils import send_string, log_message
+from utils import log_message, log_exception
+from publisher import Publisher
+from storage import StorageWriter
+from metrics import metrics, StatsServer
+from bus import Device, AcquisitionWorker, AsyncBusScheduler, device_name
 
 # directory for location of config.ini
 base_path = os.path.abspath(os.path.dirname(sys.argv[0]))
 
 ## Import instrument driver
 sys.path.append(base_path + '/drivers/')
-from falco import Falco
-#from smt100 import SMT100
+from registers import RegisterMap, RegisterMapInstrument
+from ports import port_manager
+from aio import AsyncRTUTransport, AsyncRegisterMapDevice
 
 ## Define some utility hfunctions
 
-def create_data_file(path, header, name): 
-    #This function creates column headers for a new datafile
-    prefix  = time.strftime("%Y%m%d-%H%M%S-")
-    date    = time.strftime("%Y-%m-%d")
-    newname = path + prefix + name
-    fo      = open(newname, "w")
-    fo.write(date)
-    fo.write('\n')
-    fo.write(header)
-    fo.close()
+def open_device(port, entry):
+    # Creates the instrument of a DEVICES entry. Retries until successful
+    instrument = False
+    while not instrument:
+        try:
+            instrument = RegisterMapInstrument(port, entry['address'], entry['driver'],
+                                               static_refresh=static_refresh, retries=retries,
+                                               adaptive_timeout=adaptive_timeout,
+                                               periods=entry.get('periods'))
+        except:
+            log_exception("LOGGER",
+                    "Could not open adress '{}' at port '{}'".format(
+                    entry['address'], port))
+            log_message("LOGGER", "Waiting 5 seconds...")
+            time.sleep(5)
+
+    return Device(instrument, device_name(entry), entry.get('period', wait), entry.get('prefix', ''),
+                  breaker_failures, breaker_probe)
+
+def open_async_device(port, entry):
+    # Creates the asyncio instrument of a DEVICES entry. One transport per port
+    register_map = RegisterMap.load(entry['driver'])
+    if port not in transports:
+        transports[port] = AsyncRTUTransport.from_map(port, register_map)
+    instrument = AsyncRegisterMapDevice(transports[port], entry['address'], register_map,
+                                        static_refresh=static_refresh, retries=retries,
+                                        adaptive_timeout=adaptive_timeout,
+                                        periods=entry.get('periods'))
+
+    return Device(instrument, device_name(entry), entry.get('period', wait), entry.get('prefix', ''),
+                  breaker_failures, breaker_probe)
+
+def process(timestamp, device, data):
+    # Sends new data to the GUI and stores it in the datafile of the device.
+    # Both only queue the data for their background threads
+
+    # queue the data for the TCP publisher
+    publisher.publish(timestamp, device.tag(data))
+
+    # queue the data for the datafile of the device
+    writer.append(device.name, timestamp, data)
+
+def acquire_threads():
+    # one acquisition thread per port, all feeding the same stream
+    stream = queue.Queue()
+    workers = [AcquisitionWorker(port, devices, stream) for port, devices in buses.items()]
+    for worker in workers:
+        worker.start()
+
+    try:
+        while 1:
+            try:
+                # wait for new data from any port
+                try:
+                    timestamp, device, data = stream.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+                process(timestamp, device, data)
+
+            except KeyboardInterrupt:
+                raise
+
+            except:
+                # drop the sample, the other devices go on
+                metrics.count('logger.errors')
+                log_exception("LOGGER", "could not process the data of '{}'".format(device.name))
+    finally:
+        for worker in workers:
+            worker.stop()
+
+async def acquire_async():
+    # one polling task per port in a single event loop. Sending and writing
+    # run in their own threads, overlapping with the acquisition.
+    stream = asyncio.Queue()
+    tasks = [asyncio.ensure_future(AsyncBusScheduler(port, devices).run(stream))
+             for port, devices in buses.items()]
 
-    return newname
+    try:
+        while 1:
+            timestamp, device, data = await stream.get()
+            try:
+                process(timestamp, device, data)
+            except:
+                metrics.count('logger.errors')
+                log_exception("LOGGER", "could not process the data of '{}'".format(device.name))
+    finally:
+        for task in tasks:
+            task.cancel()
+        for transport in transports.values():
+            transport.close()
 
 ## Start logging script ##
 
@@ -43,144 +127,99 @@ if os.path.exists(config_file):
     
     sensor_port         = eval(config['GENERAL_SETTINGS']['PORT'])
     sensor_address      = eval(config['GENERAL_SETTINGS']['ADDRESS'])
+    sensor_driver       = eval(config['GENERAL_SETTINGS'].get('DRIVER', "'falco'"))
+    devices_config      = eval(config['GENERAL_SETTINGS'].get('DEVICES', '[]'))
     data_path           = eval(config['GENERAL_SETTINGS']['DATA_PATH']) + '/'
     
     server_name         = eval(config['TCP_INTERFACE']['HOST_NAME'])
     server_port         = eval(config['TCP_INTERFACE']['HOST_PORT'])
+    send_queue          = eval(config['TCP_INTERFACE'].get('SEND_QUEUE', '1000'))
+    stats_port          = eval(config['TCP_INTERFACE'].get('STATS_PORT', '0'))
     
     buffersize          = eval(config['LOGGER']['BUFFER'])
     wait                = eval(config['LOGGER']['WAIT'])
+    static_refresh      = eval(config['LOGGER'].get('STATIC_REFRESH', '600'))
+    retries             = eval(config['LOGGER'].get('RETRIES', '2'))
+    adaptive_timeout    = eval(config['LOGGER'].get('ADAPTIVE_TIMEOUT', 'True'))
+    breaker_failures    = eval(config['LOGGER'].get('BREAKER_FAILURES', '3'))
+    breaker_probe       = eval(config['LOGGER'].get('BREAKER_PROBE', '10'))
+    transport           = eval(config['LOGGER'].get('TRANSPORT', "'minimalmodbus'"))
+    fsync_interval      = eval(config['LOGGER'].get('FSYNC', '0'))
+    storage_format      = eval(config['LOGGER'].get('FORMAT', "'text'"))
     basefilename        = eval(config['LOGGER']['DATAFILE'])
     extension           = eval(config['LOGGER']['EXTENSION'])
 else:
     log_message("GUI", "Could not find the configuration file: {}".format(config_file))
     exit()
 
+# Without a DEVICES list a single device is read from PORT/ADDRESS/DRIVER
+if not devices_config:
+    devices_config = [{'driver': sensor_driver, 'address': sensor_address,
+                       'period': wait, 'name': basefilename}]
+
 # Socket information in line to the port where the server is listening
 server_address = (server_name, server_port)
-sock = 0
+publisher = Publisher(server_address, send_queue)
 log_message("LOGGER", 'starting up on %s port %s' %server_address)
 
-# Variables
-counter = 0         # counter for writing data to datafile every n cycles
-filename = basefilename + extension # datafile name (date/time will be added)
-filedate = False    # date of creation of current datafile
-x=''                # data buffer (string) for writing to datafile every n cycles
-data_string = ''    # string of new data (only last cycle)
-header_string = ''  # header to be used for new datafile (refreshed every cycle)
-
-sensor = False
-
-while not sensor:
-    try:
-        sensor = Falco(sensor_port, sensor_address)
-    #    sensor = SMT100(sensor_port, sensor_address)
-    except:
+# Devices grouped by port. The writer keeps one datafile per device (date/time will be added)
+buses = {}
+writer = StorageWriter(data_path, extension, buffersize, fsync_interval,
+                       backend=storage_format)
+transports = {}
+for entry in devices_config:
+    port = entry.get('port', sensor_port)
+    if transport == 'asyncio':
+        device = open_async_device(port, entry)
+    else:
+        device = open_device(port, entry)
+    buses.setdefault(port, []).append(device)
+    log_message("LOGGER", "Polling '{}' on {} every {} s".format(device.name, port, device.period))
+
+writer.start()
+publisher.start()
+
+# latency histograms and error counters over HTTP (see metrics.py)
+if stats_port:
+    stats_server = StatsServer(('127.0.0.1', stats_port))
+
+try:
+    if transport == 'asyncio':
+        asyncio.run(acquire_async())
+    else:
+        acquire_threads()
+
+except KeyboardInterrupt:
+    log_message("LOGGER", "aborted by user!")
+    log_message("LOGGER", "Writing data...")
+
+    writer.stop()
+
+    for devices in buses.values():
+        for device in devices:
+            log_message("LOGGER",
+                "Device {name}: {polls} polls, {missed} missed slots, "
+                "jitter {jitter_mean:.4f} s mean, {jitter_max:.4f} s max, "
+                "{trips} breaker trips".format(**device.stats()))
+
+    for stats in port_manager.stats():
         log_message("LOGGER",
-                "Could not open adress '{}' at port '{}'".format(
-                sensor_address, sensor_port))
-        log_message("LOGGER", "Waiting 5 seconds...")
-        time.sleep(5)
-        
-olddate = datetime.datetime.now()
-
-while 1:
-    newdate = datetime.datetime.now()
-    
-    time_diff = newdate - olddate
-    if time_diff.total_seconds() > wait:     
-        
-        daytime = time.strftime("%H:%M:%S")
+            "Port {port}: {transactions} transactions, {reopens} reopens, "
+            "{saved_per_transaction:.4f} s saved per transaction "
+            "({saved_total:.1f} s in total)".format(**stats))
 
-        # initialize the datafile header data
-        columns_string = 'daytime'
-        units_string = 'hh:mm:ss'
-
-        try:
-          data_string = daytime
-
-          # receive and decode new data
-          data = sensor.readline()
-          json_string = json.dumps(data)
-          for dic in data:
-             data_string += '\t' +  repr(dic['val'])
-             columns_string += '\t' + dic['var']
-             units_string   += '\t' + dic['unit']
-
-          data_string += '\n' 
-
-          # put together the file header
-          header_string = columns_string + '\n' + units_string + '\n'
-
-          if json_string:
-            # transmit TCP data
-            sock = send_string(json_string, server_address, sock)
-
-            # update buffer and counter
-            x+= data_string
-            counter+=1;
-
-        except KeyboardInterrupt:
-           log_message("LOGGER", "aborted by user!")
-           log_message("LOGGER", "Writing data...")
-
-           if filedate:
-               fo = open(f, "a")
-               fo.write(x)
-               fo.close()
-           else:
-               log_message("LOGGER", "No data file in use...")
-
-           if sock:
-               log_message("LOGGER", "Closing socket...")
-               sock.shutdown(socket.SHUT_RDWR)
-               sock.close()
-           log_message("LOGGER", "bye...")
-           break
-
-        except:
-           log_message("LOGGER", "something went wrong... Waiting 5 seconds...")
-           log_message("LOGGER", "    --- error type: " + str(sys.exc_info()[0]))
-           log_message("LOGGER", "    --- error value: " + str(sys.exc_info()[1]))
-           exec_tb = sys.exc_info()[2]
-           fname = os.path.split(exec_tb.tb_frame.f_code.co_filename)[1]
-           log_message("LOGGER", "    --- error File: {}".format(fname))
-           log_message("LOGGER", "    --- error line: {}".format(exec_tb.tb_lineno))
-
-           time.sleep(5)
-
-        olddate = newdate
-
-        # Start a new datafile if none available
-        if not filedate and header_string:
-           # Check whether the specified data_path exists or not
-           isExist = os.path.exists(data_path)
-           if not isExist:
-               # Create a new directory because it does not exist
-               os.makedirs(data_path)
-               log_message("LOGGER", "Created path: ".format(data_path))
-
-           f = create_data_file(data_path, header=header_string, name=filename)
-           log_message("LOGGER", "Writing to Datafile: " + f)
-           filedate = newdate
-
-        if filedate:
-
-            # Create a new file at midnight
-            if newdate.day != filedate.day:
-               fo = open(f, "a")
-               fo.write(x)
-               fo.close()
-               x=''
-               counter=0
-               filedate = newdate
-               f = create_data_file(data_path, header=header_string, name=filename)
-               log_message("LOGGER", "Writing to Datafile: " + f)
-
-            # write and clear buffer if buffersize was reached
-            elif counter >= buffersize:
-               fo = open(f, "a")
-               fo.write(x)
-               fo.close()
-               x=''
-               counter=0
+    snapshot = metrics.snapshot()
+    for name, h in snapshot['histograms'].items():
+        log_message("LOGGER",
+            "{}: {count} calls, {mean:.2f} ms mean, {p50:.2f} ms p50, {p99:.2f} ms p99, "
+            "{max:.2f} ms max".format(name, **h))
+    if snapshot['counters']:
+        log_message("LOGGER", "Counters: " + ", ".join(
+            "{} {}".format(name, n) for name, n in sorted(snapshot['counters'].items())))
+
+    log_message("LOGGER", "Closing socket...")
+    publisher.stop()
+    log_message("LOGGER",
+        "Publisher: {sent} samples sent, {dropped} dropped, {reconnects} connections".format(
+        **publisher.stats()))
+    log_message("LOGGER", "bye...")
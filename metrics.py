@@ -0,0 +1,190 @@
+import json
+import time
+import threading
+import http.server
+
+from utils import log_message
+
+# Runtime instrumentation of the logger.
+#
+# The drivers, the publisher and the storage record the duration of every
+# register read, TCP send and file flush in latency histograms, and count
+# timeouts, CRC errors, retries and dropped samples. All of them live in
+# the module-level registry `metrics`. A StatsServer publishes a snapshot
+# as json over HTTP on a local port while the logger runs:
+#
+#     curl http://127.0.0.1:10002/stats
+#
+# Recording a value costs one perf_counter() call and a dictionary update.
+
+# Histogram resolution: SUB_HALF = 2**(SUB_BITS-1) buckets per power of two,
+# i.e. buckets 1/16 of their lower bound wide; reporting the middle of a
+# bucket is off by at most half of that (about 3%)
+SUB_BITS = 5
+SUB_HALF = 1 << (SUB_BITS - 1)
+
+class Histogram(object):
+    """Latency histogram with logarithmic buckets of constant relative width.
+
+    Values are recorded in seconds and stored in microseconds. Like an HDR
+    histogram, values below 2**SUB_BITS us are counted exactly and larger
+    values with a relative precision of 2**-(SUB_BITS-1).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.buckets = {}
+            self.count = 0
+            self.total = 0.0
+            self.min = None
+            self.max = None
+
+    @staticmethod
+    def bucket(us):
+        """Return the bucket index of a value in microseconds"""
+        shift = us.bit_length() - SUB_BITS
+        if shift <= 0:
+            return us
+        return shift*SUB_HALF + (us >> shift)
+
+    @staticmethod
+    def lower(index):
+        """Return the smallest value in microseconds of a bucket"""
+        if index < 2*SUB_HALF:
+            return index
+        shift = index//SUB_HALF - 1
+        return (index - shift*SUB_HALF) << shift
+
+    def record(self, seconds):
+        index = self.bucket(max(int(seconds*1e6), 0))
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.total += seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if self.max is None or seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, fraction):
+        """Return the value in seconds below which fraction of the values are"""
+        with self.lock:
+            if not self.count:
+                return 0.0
+            rank = fraction*self.count
+            seen = 0
+            for index in sorted(self.buckets):
+                seen += self.buckets[index]
+                if seen >= rank:
+                    # middle of the bucket, limited by the recorded extremes
+                    value = (self.lower(index) + self.lower(index + 1))/2e6
+                    return min(max(value, self.min), self.max)
+            return self.max
+
+    def summary(self):
+        """Return a dictionary with count, mean, percentiles and max in milliseconds"""
+        summary = {'count': self.count,
+                   'mean': 1e3*self.total/self.count if self.count else 0.0,
+                   'max': 1e3*(self.max or 0.0)}
+        for label, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999)):
+            summary[label] = 1e3*self.percentile(fraction)
+        return summary
+
+class Timer(object):
+    """Context manager recording the time spent in its block"""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.record(time.perf_counter() - self.start)
+        return False
+
+class Metrics(object):
+    """Named histograms and counters"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.start = time.time()
+
+    def histogram(self, name):
+        """Return the histogram name, creating it when needed"""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def timer(self, name):
+        """Return a context manager recording its duration in the histogram name"""
+        return Timer(self.histogram(name))
+
+    def record(self, name, seconds):
+        self.histogram(name).record(seconds)
+
+    def count(self, name, n=1):
+        """Add n to the counter name"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        """Return all the counters and histogram summaries as a dictionary"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+        return {'uptime': time.time() - self.start,
+                'counters': counters,
+                'histograms': {name: h.summary() for name, h in sorted(histograms.items())}}
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            for histogram in self.histograms.values():
+                histogram.reset()
+
+# default registry used by the logger modules
+metrics = Metrics()
+
+class StatsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/stats'):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.metrics.snapshot(), indent=1).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass    # no line per request
+
+class StatsServer(http.server.ThreadingHTTPServer):
+    """HTTP server returning the metrics snapshot as json (GET /stats).
+
+    Args:
+        * server_address (tuple): (host, port) to listen on
+        * registry (Metrics): metrics to publish
+
+    The server runs in a daemon thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, registry=metrics):
+        http.server.ThreadingHTTPServer.__init__(self, server_address, StatsHandler)
+        self.metrics = registry
+        threading.Thread(target=self.serve_forever, name='stats', daemon=True).start()
+        log_message("LOGGER", "statistics on http://{}:{}/stats".format(*server_address))
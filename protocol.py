@@ -0,0 +1,152 @@
+import json
+import struct
+
+# Framed binary protocol between logger.py and gui.py.
+#
+# Every frame starts with a header (uint32 body length, uint8 frame type)
+# followed by the body. All numbers are big endian.
+#
+#   SCHEMA frame: uint16 schema id + json {"vars": [...], "units": [...], "types": [...]}
+#                 sent once before the first data frame that uses it
+#   DATA frame:   uint16 schema id + float64 timestamp + values packed as
+#                 described by the schema types:
+#                     'd' -> float64, 'q' -> int64, 's' -> uint16 length + utf-8
+#
+# The Encoder resends its schemas after reset() (e.g. on a new connection).
+
+HEADER = struct.Struct('>IB')
+SCHEMA = 1
+DATA = 2
+
+DATA_HEADER = struct.Struct('>Hd')
+SCHEMA_ID = struct.Struct('>H')
+STRING_LENGTH = struct.Struct('>H')
+
+def value_type(value):
+    """Return the protocol type of value"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return 's'
+    if isinstance(value, int):
+        return 'q'
+    return 'd'
+
+def frame(frame_type, body):
+    """Return body with the frame header"""
+    return HEADER.pack(len(body), frame_type) + body
+
+class Schema(object):
+    """Variable names, units and value types of a data frame"""
+
+    def __init__(self, schema_id, variables, units, types):
+        self.id = schema_id
+        self.vars = list(variables)
+        self.units = list(units)
+        self.types = ''.join(types)
+        if 's' in self.types:
+            self.struct = None
+        else:
+            self.struct = struct.Struct('>' + self.types)
+
+    def pack(self, values):
+        if self.struct:
+            return self.struct.pack(*values)
+        body = b''
+        for t, v in zip(self.types, values):
+            if t == 's':
+                text = str(v).encode()
+                body += STRING_LENGTH.pack(len(text)) + text
+            else:
+                body += struct.pack('>' + t, v)
+        return body
+
+    def unpack(self, body, offset):
+        if self.struct:
+            return self.struct.unpack_from(body, offset)
+        values = []
+        for t in self.types:
+            if t == 's':
+                length = STRING_LENGTH.unpack_from(body, offset)[0]
+                offset += STRING_LENGTH.size
+                values.append(body[offset:offset+length].decode())
+                offset += length
+            else:
+                values.append(struct.unpack_from('>' + t, body, offset)[0])
+                offset += 8
+        return values
+
+    def encode(self):
+        """Return the SCHEMA frame of this schema"""
+        body = json.dumps({'vars': self.vars, 'units': self.units,
+                           'types': self.types}).encode()
+        return frame(SCHEMA, SCHEMA_ID.pack(self.id) + body)
+
+class Encoder(object):
+    """Converts readline() lists into frames"""
+
+    def __init__(self):
+        self.schemas = {}
+        self.sent = set()
+
+    def reset(self):
+        """Send the schemas again before the next data frames"""
+        self.sent = set()
+
+    def encode(self, data, timestamp):
+        """Return the frame(s) for data (list of {'var','val','unit'} dictionaries)"""
+        key = tuple((dic['var'], dic['unit'], value_type(dic['val'])) for dic in data)
+        schema = self.schemas.get(key)
+        if schema is None:
+            schema = self.schemas[key] = Schema(len(self.schemas),
+                                                [k[0] for k in key],
+                                                [k[1] for k in key],
+                                                [k[2] for k in key])
+        message = b''
+        if schema.id not in self.sent:
+            message = schema.encode()
+            self.sent.add(schema.id)
+
+        body = DATA_HEADER.pack(schema.id, timestamp) + schema.pack([dic['val'] for dic in data])
+        return message + frame(DATA, body)
+
+class Decoder(object):
+    """Reassembles frames from a byte stream.
+
+    feed() accepts any chunk of received bytes and returns the complete
+    data messages as a list of (timestamp, data) tuples, where data is a
+    list of {'var','val','unit'} dictionaries.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.schemas = {}
+
+    def feed(self, chunk):
+        self.buffer.extend(chunk)
+        messages = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            length, frame_type = HEADER.unpack_from(self.buffer, offset)
+            end = offset + HEADER.size + length
+            if end > len(self.buffer):
+                break
+            body = bytes(self.buffer[offset + HEADER.size:end])
+            offset = end
+
+            if frame_type == SCHEMA:
+                schema_id = SCHEMA_ID.unpack_from(body)[0]
+                info = json.loads(body[SCHEMA_ID.size:].decode())
+                self.schemas[schema_id] = Schema(schema_id, info['vars'],
+                                                 info['units'], info['types'])
+            elif frame_type == DATA:
+                schema_id, timestamp = DATA_HEADER.unpack_from(body)
+                schema = self.schemas.get(schema_id)
+                if schema is None:
+                    # data before its schema (e.g. joined mid stream)
+                    continue
+                values = schema.unpack(body, DATA_HEADER.size)
+                messages.append((timestamp,
+                    [{'var': v, 'val': x, 'unit': u}
+                     for v, x, u in zip(schema.vars, values, schema.units)]))
+
+        del self.buffer[:offset]
+        return messages
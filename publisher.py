@@ -0,0 +1,123 @@
+import time
+import socket
+import threading
+import collections
+
+from utils import log_message
+from protocol import Encoder
+from metrics import metrics
+
+# Non blocking publication of the logger data.
+#
+# publish() only appends the sample to a bounded ring buffer. A background
+# thread connects to the broker, sends everything in the ring and
+# reconnects with exponential backoff when the broker is not available.
+# When the ring is full the oldest samples are dropped, so the sampling
+# loop never waits for the network.
+
+class Publisher(threading.Thread):
+    """Background sender of data frames to a TCP server (broker.py).
+
+    Args:
+        * server_address (tuple): (host, port) of the server
+        * maxsize (int): samples kept while the server is not reachable
+        * min_backoff, max_backoff (float): seconds between reconnection
+          attempts. The delay doubles after every failed attempt
+    """
+
+    def __init__(self, server_address, maxsize=1000, min_backoff=0.5, max_backoff=30):
+        threading.Thread.__init__(self, name='publisher', daemon=True)
+        self.server_address = server_address
+        self.ring = collections.deque(maxlen=maxsize)
+        self.ready = threading.Condition()
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        self.encoder = Encoder()
+        self.sock = None
+        self.stopped = False
+
+        # statistics
+        self.sent = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+    def publish(self, timestamp, data):
+        """Queue one sample (list of {'var','val','unit'} dictionaries). Never blocks"""
+        with self.ready:
+            if len(self.ring) == self.ring.maxlen:
+                self.dropped += 1
+                metrics.count('publisher.dropped')
+            self.ring.append((timestamp, data))
+            self.ready.notify()
+
+    def stop(self):
+        """Send the pending samples (if connected) and close the connection"""
+        with self.ready:
+            self.stopped = True
+            self.ready.notify()
+        self.join(timeout=2)
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+            self.sock = None
+
+    def connect(self):
+        try:
+            self.sock = socket.create_connection(self.server_address, timeout=self.max_backoff)
+        except socket.error:
+            self.sock = None
+            return False
+        self.encoder.reset()    # new connection, send the schemas again
+        self.backoff = self.min_backoff
+        self.reconnects += 1
+        log_message("LOGGER", "connected to {}".format(self.server_address))
+        return True
+
+    def run(self):
+        next_attempt = 0
+        while 1:
+            with self.ready:
+                while not self.ring and not self.stopped:
+                    self.ready.wait()
+                if self.stopped and (not self.ring or not self.sock):
+                    break
+
+            if not self.sock:
+                # wait for the next reconnection attempt. Samples keep
+                # accumulating (and dropping) in the ring meanwhile
+                delay = next_attempt - time.monotonic()
+                if delay > 0:
+                    with self.ready:
+                        self.ready.wait(delay)
+                    continue
+                if not self.connect():
+                    next_attempt = time.monotonic() + self.backoff
+                    self.backoff = min(2*self.backoff, self.max_backoff)
+                    continue
+
+            with self.ready:
+                items = list(self.ring)
+                self.ring.clear()
+
+            try:
+                payload = b''.join(self.encoder.encode(data, timestamp)
+                                   for timestamp, data in items)
+                with metrics.timer('tcp.send'):
+                    self.sock.sendall(payload)
+                self.sent += len(items)
+            except socket.error:
+                log_message("LOGGER", "connection to {} lost".format(self.server_address))
+                self.sock.close()
+                self.sock = None
+                self.dropped += len(items)
+                metrics.count('publisher.dropped', len(items))
+                next_attempt = time.monotonic() + self.backoff
+
+    def stats(self):
+        """Return a dictionary with the publication counters"""
+        return {'sent': self.sent, 'dropped': self.dropped,
+                'reconnects': self.reconnects, 'pending': len(self.ring)}
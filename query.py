@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+#
+# Time range queries over the daily datafiles written by logger.py.
+#
+# Every datafile gets a sidecar index (datafile name + INDEX_EXTENSION)
+# with the time and byte offset of every block of rows (every
+# INDEX_BLOCK lines of a text file, every row group of a columnar file).
+# A query only reads the datafiles overlapping the time range, seeks to
+# the block containing the start and stops after the block containing the
+# end. The rows are returned in chunks, so the memory used depends on the
+# size of the result and not on the size of the files. The indexes are
+# extended automatically when the datafiles grow.
+#
+# Command line:
+#   python query.py '2023-01-01 12:00' '2023-01-01 13:00' --vars VOC T
+#
+# Python:
+#   from query import query_arrays
+#   columns = query_arrays('/home/pi/RS485/data/', 'falco', '.txt', start, end, ['VOC'])
+
+import os, sys
+import json
+import time
+import argparse
+import datetime
+import configparser
+import numpy as np
+
+from utils import log_message
+from storage import (COLUMNAR_MAGIC, datafiles, read_text_header, line_seconds, parse_text,
+                     read_columnar_header, read_group_header, row_group_size,
+                     read_row_group)
+
+# path where the config.ini file is located
+base_path = os.path.abspath(os.path.dirname(sys.argv[0]))
+
+INDEX_EXTENSION = '.idx'
+INDEX_BLOCK = 1024          # text lines per index entry
+CHUNK_SIZE = 1 << 20        # bytes read at once from text datafiles
+
+def is_columnar(filename):
+    with open(filename, "rb") as fo:
+        return fo.read(len(COLUMNAR_MAGIC)) == COLUMNAR_MAGIC
+
+class DataIndex(object):
+    """Sidecar index of one datafile.
+
+    Args:
+        * filename (str): datafile
+
+    times[i] is the time of the first row of block i and offsets[i] its
+    byte position in the datafile. size is the end of the last complete
+    row indexed so far.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.path = filename + INDEX_EXTENSION
+        self.columnar = is_columnar(filename)
+        self.reset()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as fo:
+                    data = json.load(fo)
+                if data['size'] <= os.path.getsize(filename):
+                    self.size = data['size']
+                    self.rows = data['rows']
+                    self.times = data['times']
+                    self.offsets = data['offsets']
+            except (OSError, ValueError, KeyError):
+                self.reset()    # corrupt index, build it again
+        self.update()
+
+    def reset(self):
+        self.size = 0
+        self.rows = 0
+        self.times = []
+        self.offsets = []
+
+    def update(self):
+        """Index the rows added to the datafile since the last update"""
+        size = self.size
+        if self.columnar:
+            self.index_columnar()
+        else:
+            self.index_text()
+        if self.size != size:
+            self.save()
+
+    def index_text(self):
+        with open(self.filename, "rb") as fo:
+            midnight, names, units = read_text_header(fo)
+            position = max(self.size, fo.tell())
+            while 1:
+                fo.seek(position)
+                chunk = fo.read(CHUNK_SIZE)
+                # only complete lines are indexed
+                ends = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+                if not len(ends):
+                    break
+                starts = np.concatenate(([0], ends[:-1] + 1))
+                first = (-self.rows) % INDEX_BLOCK
+                for start in starts[first::INDEX_BLOCK]:
+                    self.times.append(float(midnight + line_seconds(
+                        np.array([chunk[start:start+8]]))[0]))
+                    self.offsets.append(int(position + start))
+                self.rows += len(starts)
+                position += int(ends[-1]) + 1
+                if len(chunk) < CHUNK_SIZE:
+                    break
+            self.size = position
+
+    def index_columnar(self):
+        with open(self.filename, "rb") as fo:
+            header = read_columnar_header(fo)
+            position = max(self.size, fo.tell())
+            end = fo.seek(0, os.SEEK_END)
+            while position + 4 <= end:
+                fo.seek(position)
+                group = read_group_header(fo, header)
+                if group is None:
+                    break
+                rows, dtypes = group
+                length = fo.tell() - position + row_group_size(dtypes, rows)
+                if position + length > end:
+                    break   # row group still being written
+                # the time column is stored first
+                self.times.append(float(np.frombuffer(fo.read(8), dtype='<f8')[0]))
+                self.offsets.append(position)
+                self.rows += int(rows)
+                position += length
+            self.size = position
+
+    def save(self):
+        data = {'size': self.size, 'rows': self.rows,
+                'times': self.times, 'offsets': self.offsets}
+        try:
+            with open(self.path + '.tmp', "w") as fo:
+                json.dump(data, fo)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            # e.g. read only data directory, the index is rebuilt next time
+            log_message("QUERY", "Could not write index {}: {}".format(self.path, e))
+
+    def span(self, start, end):
+        """Return the byte range (first, last) of the blocks overlapping [start, end]"""
+        if not self.offsets:
+            return self.size, self.size
+        first = max(int(np.searchsorted(self.times, start, 'right')) - 1, 0)
+        last = int(np.searchsorted(self.times, end, 'right'))
+        return (self.offsets[first],
+                self.offsets[last] if last < len(self.offsets) else self.size)
+
+def file_start(filename):
+    """Return the time of the first line of a datafile from its name in seconds since the epoch"""
+    prefix = os.path.basename(filename)[:15]
+    return time.mktime(time.strptime(prefix, "%Y%m%d-%H%M%S"))
+
+def select(columns, start, end):
+    mask = (columns['time'] >= start) & (columns['time'] <= end)
+    if mask.all():
+        return columns
+    return {var: values[mask] for var, values in columns.items()}
+
+def query_file(filename, start, end, variables=None):
+    """Yield the rows of a datafile between start and end (seconds since the
+    epoch) as dictionaries var -> numpy array, one chunk at a time"""
+    index = DataIndex(filename)
+    first, last = index.span(start, end)
+
+    with open(filename, "rb") as fo:
+        if index.columnar:
+            header = read_columnar_header(fo)
+            fo.seek(first)
+            while fo.tell() < last:
+                group = read_row_group(fo, header, variables)
+                if group is None:
+                    break
+                columns = select(group, start, end)
+                if len(columns['time']):
+                    yield columns
+        else:
+            midnight, names, units = read_text_header(fo)
+            position = first
+            while position < last:
+                fo.seek(position)
+                chunk = fo.read(min(CHUNK_SIZE, last - position))
+                lines = chunk.split(b'\n')
+                if len(lines) == 1:
+                    break
+                position += len(chunk) - len(lines[-1])
+                columns = select(parse_text(lines[:-1], names, midnight, variables),
+                                 start, end)
+                if len(columns['time']):
+                    yield columns
+
+def query(path, name, extension, start, end, variables=None):
+    """Yield the rows of the device name between start and end (seconds since
+    the epoch) over all its datafiles, one chunk at a time.
+
+    Each chunk is a dictionary var -> numpy array including 'time'. With
+    variables only these columns are read.
+    """
+    filenames = datafiles(path, name, extension)
+    starts = [file_start(f) for f in filenames] + [float('inf')]
+    for i, filename in enumerate(filenames):
+        # each file ends at the first line of the next one or at midnight
+        day_end = time.mktime((datetime.date.fromtimestamp(starts[i])
+                               + datetime.timedelta(days=1)).timetuple())
+        if starts[i] > end or min(starts[i+1], day_end) < start:
+            continue
+        for columns in query_file(filename, start, end, variables):
+            yield columns
+
+def query_arrays(path, name, extension, start, end, variables=None):
+    """Return the result of query() as one dictionary var -> numpy array"""
+    chunks = list(query(path, name, extension, start, end, variables))
+    if not chunks:
+        return {}
+    return {var: np.concatenate([c[var] for c in chunks if var in c]) for var in chunks[-1]}
+
+def query_frame(path, name, extension, start, end, variables=None):
+    """Return the result of query() as a pandas DataFrame indexed by time"""
+    import pandas as pd
+    frame = pd.DataFrame(query_arrays(path, name, extension, start, end, variables))
+    if 'time' in frame:
+        frame.index = pd.to_datetime(frame.pop('time'), unit='s')
+    return frame
+
+def parse_time(text):
+    """Return seconds since the epoch from a number or an ISO date/time string"""
+    try:
+        return float(text)
+    except ValueError:
+        return time.mktime(datetime.datetime.fromisoformat(text).timetuple())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Print the logged data between two times as tab separated lines")
+    parser.add_argument('start', help="start time ('2023-01-01 12:00' or seconds since the epoch)")
+    parser.add_argument('end', help="end time")
+    parser.add_argument('--vars', nargs='+', help="variables to print (default all)")
+    parser.add_argument('--name', help="device name (default DATAFILE of config.ini)")
+    parser.add_argument('--path', help="data directory (default DATA_PATH of config.ini)")
+    parser.add_argument('--extension', help="datafile extension (default EXTENSION of config.ini)")
+    args = parser.parse_args()
+
+    # READ ini file for the defaults
+    config_file = base_path + '/config.ini'
+    if os.path.exists(config_file):
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        args.path = args.path or eval(config['GENERAL_SETTINGS']['DATA_PATH']) + '/'
+        args.name = args.name or eval(config['LOGGER']['DATAFILE'])
+        args.extension = args.extension or eval(config['LOGGER']['EXTENSION'])
+    elif not (args.path and args.name and args.extension):
+        log_message("QUERY", "Could not find the configuration file: {}".format(config_file))
+        exit()
+
+    header = None
+    for columns in query(args.path, args.name, args.extension,
+                         parse_time(args.start), parse_time(args.end), args.vars):
+        names = [v for v in columns if v != 'time']
+        if names != header:
+            header = names
+            print('\t'.join(['time'] + names))
+        times = [datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S")
+                 for t in columns['time']]
+        rows = zip(times, *[columns[v] for v in names])
+        sys.stdout.write(''.join('\t'.join(str(x) for x in row) + '\n' for row in rows))
@@ -0,0 +1,539 @@
+import os
+import glob
+import time
+import json
+import queue
+import struct
+import datetime
+import threading
+import numpy as np
+
+from utils import log_message, log_exception
+from metrics import metrics
+
+# Storage of the logged data.
+#
+# DataFile buffers the lines of one device and writes them to a daily
+# file. StorageWriter owns all the DataFiles and runs them in a background
+# thread fed by a bounded queue, so that slow writes (e.g. on SD cards) do
+# not delay the acquisition. The file format is selected with FORMAT in the
+# [LOGGER] section of config.ini (see BACKENDS).
+
+def create_data_file(path, header, name, filedate=None):
+    #This function creates column headers for a new datafile. filedate
+    #(datetime of the first line, default now) gives the name and the date
+    if filedate is None:
+        filedate = datetime.datetime.now()
+    prefix  = filedate.strftime("%Y%m%d-%H%M%S-")
+    date    = filedate.strftime("%Y-%m-%d")
+    newname = path + prefix + name
+    fo      = open(newname, "w")
+    fo.write(date)
+    fo.write('\n')
+    fo.write(header)
+    fo.close()
+
+    return newname
+
+class DataFile(object):
+    """Buffered daily data file of one device (tab separated text backend).
+
+    Args:
+        * path (str): data directory (with trailing '/')
+        * name (str): file name. Date and time of creation will be added
+        * buffersize (int): lines kept in memory before writing to the file
+
+    Other backends derive from this class and replace set_header(),
+    add_line(), create() and write_buffer().
+    """
+
+    file_mode = "a"     # mode used to open the datafile for appending
+
+    def __init__(self, path, name, buffersize):
+        self.path = path
+        self.name = name
+        self.buffersize = buffersize
+
+        self.counter = 0         # counter for writing data to datafile every n cycles
+        self.filedate = False    # date of creation of current datafile
+        self.filename = ''       # current datafile
+        self.x = ''              # data buffer (string) for writing to datafile every n cycles
+        self.header_string = ''  # header to be used for new datafile
+        self.fo = None           # open file handle of the current datafile
+        self.dirty = False       # data written since the last sync()
+
+    def append(self, timestamp, data):
+        """Add one line of data (list of {'var','val','unit'} dictionaries)
+
+        timestamp is the acquisition time in seconds since the epoch.
+        """
+        newdate = datetime.datetime.fromtimestamp(timestamp)
+
+        # refresh the header used for the next datafile
+        self.set_header(data)
+
+        # Start a new datafile if none available or at midnight
+        if not self.filedate:
+            self.new_file(newdate)
+        elif newdate.day != self.filedate.day:
+            self.flush()
+            self.new_file(newdate)
+
+        # update buffer and counter
+        self.add_line(timestamp, newdate, data)
+        self.counter += 1
+
+        # write and clear buffer if buffersize was reached
+        if self.counter >= self.buffersize:
+            self.flush()
+
+    def set_header(self, data):
+        # initialize the datafile header data
+        columns_string = 'daytime'
+        units_string = 'hh:mm:ss'
+        for dic in data:
+            columns_string += '\t' + dic['var']
+            units_string   += '\t' + dic['unit']
+
+        # put together the file header
+        self.header_string = columns_string + '\n' + units_string + '\n'
+
+    def add_line(self, timestamp, newdate, data):
+        data_string = newdate.strftime("%H:%M:%S")
+        for dic in data:
+            data_string += '\t' +  repr(dic['val'])
+        self.x += data_string + '\n'
+
+    def create(self, filedate):
+        """Create a new datafile for lines starting at filedate (datetime) and return its name
+
+        The name and the date of the file are taken from filedate and not
+        from the clock, as the lines may be written later by the writer thread.
+        """
+        return create_data_file(self.path, header=self.header_string, name=self.name,
+                                filedate=filedate)
+
+    def write_buffer(self):
+        self.fo.write(self.x)
+        self.x = ''
+
+    def new_file(self, newdate):
+        # Check whether the specified data_path exists or not
+        if not os.path.exists(self.path):
+            # Create a new directory because it does not exist
+            os.makedirs(self.path)
+            log_message("LOGGER", "Created path: {}".format(self.path))
+
+        self.close()
+        self.filename = self.create(newdate)
+        log_message("LOGGER", "Writing to Datafile: " + self.filename)
+        self.filedate = newdate
+        self.fo = open(self.filename, self.file_mode)
+
+    def flush(self):
+        """Write the buffered lines to the datafile"""
+        if self.fo and self.counter:
+            with metrics.timer('storage.flush'):
+                self.write_buffer()
+                self.fo.flush()
+            self.dirty = True
+        self.counter = 0
+
+    def sync(self):
+        """Force the written lines to disk (fsync)"""
+        if self.fo and self.dirty:
+            with metrics.timer('storage.fsync'):
+                os.fsync(self.fo.fileno())
+            self.dirty = False
+
+    def close(self):
+        """Write the buffer and close the datafile"""
+        if self.fo:
+            self.flush()
+            self.sync()
+            self.fo.close()
+            self.fo = None
+
+# Columnar binary datafile layout:
+#   COLUMNAR_MAGIC
+#   uint32 header length + json header {"date", "columns": [{"var", "unit", "dtype"}]}
+#   row groups: uint32 number of rows n, a uint32 width for each text column
+#   (dtype 'S'), then for each column n values (dtype, 'S<width>' for text)
+# Text columns are sized for the longest value of each row group. Files of
+# earlier versions use fixed 'S16' text columns without widths.
+# All integers are little endian. The first column is the acquisition time
+# in seconds since the epoch.
+COLUMNAR_MAGIC = b'RS485COL'
+
+def column_dtype(value):
+    """Return the numpy dtype string used to store value.
+
+    Integers are stored as floats too (exact for register values), so that
+    gaps can be written as NaN in every numeric column.
+    """
+    if isinstance(value, (bool, int, float, np.integer, np.floating)):
+        return '<f8'
+    return 'S'
+
+class ColumnarDataFile(DataFile):
+    """Buffered daily data file with typed binary columns.
+
+    Each flush of the buffer appends one row group (see COLUMNAR_MAGIC).
+    Column names, units and types are stored in the header of the file.
+    Use read_columnar() to load the data.
+    """
+
+    file_mode = "ab"
+
+    def __init__(self, path, name, buffersize):
+        DataFile.__init__(self, path, name, buffersize)
+        self.columns = []   # column descriptions of the current datafile
+        self.rows = []      # buffered rows (tuples ordered as self.columns)
+
+    def set_header(self, data):
+        self.header_columns = [{'var': 'time', 'unit': 's', 'dtype': '<f8'}]
+        for dic in data:
+            self.header_columns.append({'var': dic['var'], 'unit': dic['unit'],
+                                        'dtype': column_dtype(dic['val'])})
+
+    def add_line(self, timestamp, newdate, data):
+        values = {dic['var']: dic['val'] for dic in data}
+        row = [timestamp]
+        for column in self.columns[1:]:
+            value = values.get(column['var'])
+            if value is None:
+                value = np.nan if column['dtype'] == '<f8' else 0
+            row.append(value)
+        self.rows.append(tuple(row))
+
+    def create(self, filedate):
+        prefix  = filedate.strftime("%Y%m%d-%H%M%S-")
+        newname = self.path + prefix + self.name
+        self.columns = self.header_columns
+        header = json.dumps({'date': filedate.strftime("%Y-%m-%d"),
+                             'columns': self.columns}).encode()
+        with open(newname, "wb") as fo:
+            fo.write(COLUMNAR_MAGIC)
+            fo.write(struct.pack('<I', len(header)))
+            fo.write(header)
+
+        return newname
+
+    def write_buffer(self):
+        widths = []
+        arrays = []
+        for index, column in enumerate(self.columns):
+            values = [row[index] for row in self.rows]
+            dtype = column['dtype']
+            if dtype == 'S':
+                values = [str(v).encode() for v in values]
+                width = max(max(len(v) for v in values), 1)
+                widths.append(width)
+                dtype = 'S{}'.format(width)
+            arrays.append(np.asarray(values, dtype=dtype).tobytes())
+        chunk = [struct.pack('<I', len(self.rows))]
+        chunk += [struct.pack('<I', width) for width in widths]
+        self.fo.write(b''.join(chunk + arrays))
+        self.rows = []
+
+def read_columnar_header(fo):
+    """Return the header of the columnar datafile fo.
+
+    fo is left at the first row group.
+    """
+    if fo.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError("{} is not a columnar datafile".format(fo.name))
+    length = struct.unpack('<I', fo.read(4))[0]
+    return json.loads(fo.read(length).decode())
+
+def read_group_header(fo, header):
+    """Return (rows, dtypes) of the row group at the position of fo, or None
+    at the end of the file. fo is left at the first column"""
+    count = fo.read(4)
+    if len(count) < 4:
+        return None
+    rows = struct.unpack('<I', count)[0]
+    dtypes = [c['dtype'] for c in header['columns']]
+    texts = dtypes.count('S')
+    if texts:
+        widths = fo.read(4*texts)
+        if len(widths) < 4*texts:
+            return None
+        widths = iter(struct.unpack('<{}I'.format(texts), widths))
+        dtypes = ['S{}'.format(next(widths)) if d == 'S' else d for d in dtypes]
+    return rows, [np.dtype(d) for d in dtypes]
+
+def row_group_size(dtypes, rows):
+    """Return the bytes used by the columns of a row group of rows lines"""
+    return rows*sum(dtype.itemsize for dtype in dtypes)
+
+def read_row_group(fo, header, variables=None):
+    """Return the columns (dictionary var -> numpy array) of the row group at
+    the position of fo, or None at the end of the file.
+
+    With variables only these columns (and 'time') are returned.
+    """
+    group = read_group_header(fo, header)
+    if group is None:
+        return None
+    rows, dtypes = group
+    content = fo.read(row_group_size(dtypes, rows))
+    if len(content) < row_group_size(dtypes, rows):
+        return None     # row group still being written
+
+    columns = {}
+    offset = 0
+    for column, dtype in zip(header['columns'], dtypes):
+        if variables is None or column['var'] == 'time' or column['var'] in variables:
+            columns[column['var']] = np.frombuffer(content, dtype=dtype, count=rows,
+                                                   offset=offset)
+        offset += rows*dtype.itemsize
+    return columns
+
+def read_columnar(filename):
+    """Return (columns, units) of a columnar datafile.
+
+    columns is a dictionary var -> numpy array (including 'time') and units
+    a dictionary var -> unit string.
+    """
+    with open(filename, "rb") as fo:
+        header = read_columnar_header(fo)
+        groups = []
+        while 1:
+            group = read_row_group(fo, header)
+            if group is None:
+                break
+            groups.append(group)
+
+    columns = {}
+    for column in header['columns']:
+        parts = [group[column['var']] for group in groups]
+        columns[column['var']] = np.concatenate(parts) if parts else np.array([], dtype=column['dtype'])
+    units = {c['var']: c['unit'] for c in header['columns']}
+
+    return columns, units
+
+def to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+def read_text_header(fo):
+    """Return (midnight, names, units) of the text datafile fo.
+
+    midnight is the start of the day of the file in seconds since the
+    epoch, names and units the lists of the header lines. fo is left at
+    the first data line.
+    """
+    date = fo.readline().decode().strip()
+    names = fo.readline().decode().rstrip('\n').split('\t')
+    units = fo.readline().decode().rstrip('\n').split('\t')
+    return time.mktime(time.strptime(date, "%Y-%m-%d")), names, units
+
+def line_seconds(table):
+    """Return the seconds since midnight of an array of hh:mm:ss bytes"""
+    digits = table.astype('S8').view(np.uint8).reshape(-1, 8).astype(int) - ord('0')
+    return ((digits[:, 0]*10 + digits[:, 1])*3600 + (digits[:, 3]*10 + digits[:, 4])*60
+            + digits[:, 6]*10 + digits[:, 7])
+
+def parse_text(lines, names, midnight, variables=None):
+    """Return the columns (dictionary var -> numpy array) of complete text lines.
+
+    The values are converted column by column with numpy. With variables
+    only these columns (and 'time') are converted.
+    """
+    fields = b'\t'.join(lines).split(b'\t') if lines else []
+    if len(fields) == len(lines)*len(names):
+        table = np.array(fields, dtype=bytes).reshape(-1, len(names))
+    else:
+        # skip malformed lines (e.g. written while the file was copied)
+        fields = [line.split(b'\t') for line in lines]
+        table = np.array([f for f in fields if len(f) == len(names)], dtype=bytes)
+        table = table.reshape(-1, len(names))
+
+    # daytime column hh:mm:ss -> seconds since the epoch
+    columns = {'time': midnight + line_seconds(table[:, 0])}
+
+    for index, name in enumerate(names[1:], 1):
+        if variables is not None and name not in variables:
+            continue
+        try:
+            columns[name] = table[:, index].astype(float)
+        except ValueError:
+            values = np.array([to_float(v) for v in table[:, index]])
+            if np.isnan(values).all():
+                # text values are stored with repr()
+                values = np.array([v.decode().strip("'") for v in table[:, index]])
+            columns[name] = values
+
+    return columns
+
+def read_text(filename, rows=None):
+    """Return (columns, units) of a text datafile (see read_columnar).
+
+    With rows only the last rows lines are read: the file is read backwards
+    in chunks, so the cost does not depend on the file length.
+    """
+    with open(filename, "rb") as fo:
+        midnight, names, unit_names = read_text_header(fo)
+        start = fo.tell()
+        end = fo.seek(0, os.SEEK_END)
+
+        position = start
+        if rows is not None:
+            # read chunks from the end until enough lines are available
+            position = end
+            body = b''
+            while position > start and body.count(b'\n') <= rows:
+                size = min(1 << 20, position - start)
+                position -= size
+                fo.seek(position)
+                body = fo.read(size) + body
+        if position == start:
+            fo.seek(start)
+            body = fo.read()
+
+    lines = body.split(b'\n')
+    if position > start:
+        lines = lines[1:]       # incomplete first line
+    lines = lines[:-1]          # empty or incomplete last line
+    if rows is not None:
+        lines = lines[max(len(lines)-rows, 0):] if rows else []
+
+    columns = parse_text(lines, names, midnight)
+    units = {'time': 's'}
+    for index, name in enumerate(names[1:], 1):
+        units[name] = unit_names[index] if index < len(unit_names) else '-'
+
+    return columns, units
+
+def read_datafile(filename, rows=None):
+    """Return (columns, units) of a datafile of any backend.
+
+    With rows only the last rows lines are returned.
+    """
+    with open(filename, "rb") as fo:
+        columnar = fo.read(len(COLUMNAR_MAGIC)) == COLUMNAR_MAGIC
+    if not columnar:
+        return read_text(filename, rows)
+
+    columns, units = read_columnar(filename)
+    if rows is not None:
+        columns = {var: values[max(len(values)-rows, 0):] if rows else values[:0]
+                   for var, values in columns.items()}
+    return columns, units
+
+def datafiles(path, name, extension):
+    """Return the datafiles of the device name in path, oldest first"""
+    pattern = '[0-9]'*8 + '-' + '[0-9]'*6 + '-' + glob.escape(name + extension)
+    return sorted(glob.glob(os.path.join(glob.escape(path), pattern)))
+
+def load_history(path, name, extension, rows):
+    """Return (columns, units) with the last rows lines of the device name.
+
+    The newest datafiles are read first, older files only as long as rows
+    are missing. Variables missing in some files are filled with NaN.
+    """
+    parts = []
+    units = {}
+    count = 0
+    for filename in reversed(datafiles(path, name, extension)):
+        try:
+            columns, file_units = read_datafile(filename, rows - count)
+        except Exception:
+            log_exception("STORAGE", "could not read {}".format(filename))
+            continue
+        parts.insert(0, columns)
+        units = dict(file_units, **units)
+        count += len(columns['time'])
+        if count >= rows:
+            break
+
+    history = {}
+    for var in units:
+        values = [part.get(var, np.full(len(part['time']), np.nan)) for part in parts]
+        history[var] = np.concatenate(values) if values else np.array([])
+    return history, units
+
+# storage backends selectable with FORMAT in config.ini
+BACKENDS = {
+    'text': DataFile,
+    'columnar': ColumnarDataFile,
+    }
+
+class StorageWriter(threading.Thread):
+    """Background thread writing the datafiles of all devices.
+
+    Args:
+        * path (str): data directory (with trailing '/')
+        * extension (str): datafile extension
+        * buffersize (int): lines kept in memory before writing to a file
+        * fsync_interval (float): seconds between fsync of the written files.
+          0 leaves the syncing to the operating system
+        * maxsize (int): maximum number of lines waiting in the queue. Lines
+          arriving when the queue is full are dropped and counted
+        * backend (str): datafile format, a key of BACKENDS
+
+    Creation, daily rotation and appends of the datafiles all happen in
+    this thread. append() never blocks the caller.
+    """
+
+    def __init__(self, path, extension, buffersize, fsync_interval=0, maxsize=10000,
+                 backend='text'):
+        threading.Thread.__init__(self, name='storage', daemon=True)
+        self.backend = BACKENDS[backend]
+        self.path = path
+        self.extension = extension
+        self.buffersize = buffersize
+        self.fsync_interval = fsync_interval
+        self.queue = queue.Queue(maxsize)
+        self.datafiles = {}
+        self.dropped = 0
+        self.last_sync = time.monotonic()
+
+    def append(self, name, timestamp, data):
+        """Queue one line of data of the device name"""
+        try:
+            self.queue.put_nowait((name, timestamp, data))
+        except queue.Full:
+            self.dropped += 1
+            metrics.count('storage.dropped')
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                log_message("LOGGER", "Storage queue full, {} lines dropped".format(self.dropped))
+
+    def stop(self):
+        """Write all pending lines, close the datafiles and end the thread"""
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        while 1:
+            try:
+                item = self.queue.get(timeout=self.fsync_interval or None)
+            except queue.Empty:
+                item = False
+
+            if item is None:
+                break
+
+            try:
+                if item:
+                    name, timestamp, data = item
+                    if name not in self.datafiles:
+                        self.datafiles[name] = self.backend(self.path, name + self.extension,
+                                                            self.buffersize)
+                    self.datafiles[name].append(timestamp, data)
+
+                # batched fsync of all files written since the last sync
+                if (self.fsync_interval
+                        and time.monotonic() - self.last_sync >= self.fsync_interval):
+                    for datafile in self.datafiles.values():
+                        datafile.sync()
+                    self.last_sync = time.monotonic()
+            except:
+                metrics.count('storage.errors')
+                log_exception("LOGGER", "could not write data...")
+
+        for datafile in self.datafiles.values():
+            datafile.close()
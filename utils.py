@@ -1,8 +1,7 @@
 import pyqtgraph as pg
 import datetime
 import time
-import sys
-import socket
+import sys, os
 
 def timestamp():
     return int(time.mktime(datetime.datetime.now().timetuple()))
@@ -26,21 +25,14 @@ def log_message(module, msg):
         log_message = timestamp + log_message.format(module,msg)
         print(log_message, file=sys.stderr)
 
-def send_string(line, server_address, sock = 0):
-    # Sends a string to through a TCP socket
-
-    # Send data
-    try:
-        if not sock:
-            # Create a TCP/IP socket
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(server_address)
-            
-        sock.sendall(line.encode())
-    except socket.error:
-#        print("nobody listening", file = sys.stderr)
-        sock.close()
-#        print('closing socket', file = sys.stderr)
-        sock = 0
-
-    return sock
+def log_exception(module, msg):
+        """
+        Logs msg followed by the type, value and location of the exception being handled
+        """
+        log_message(module, msg)
+        log_message(module, "    --- error type: " + str(sys.exc_info()[0]))
+        log_message(module, "    --- error value: " + str(sys.exc_info()[1]))
+        exec_tb = sys.exc_info()[2]
+        fname = os.path.split(exec_tb.tb_frame.f_code.co_filename)[1]
+        log_message(module, "    --- error File: {}".format(fname))
+        log_message(module, "    --- error line: {}".format(exec_tb.tb_lineno))